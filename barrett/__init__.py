@@ -1,7 +1,8 @@
-
 import barrett.util as util
 import barrett.posterior as posterior
 import barrett.profilelikelihood as profilelikelihood
 import barrett.data as data
+from barrett.profiling import profile
+from barrett.session import open_chain
 
-__all__ = ['posterior', 'profilelikelihood', 'data', 'util']
+__all__ = ['posterior', 'profilelikelihood', 'data', 'util', 'profile', 'open_chain']
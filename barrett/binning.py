@@ -0,0 +1,188 @@
+import numpy as np
+import scipy.special
+
+# The rules choosing the bins, see count.
+RULES = ('auto', 'sqrt', 'sturges', 'fd', 'knuth', 'quantile')
+
+# Largest grid, in bytes, the bins may give unless told otherwise, see cap.
+BUDGET = 256*2**20
+
+
+def edges(bins, limits):
+    """Bin edges from a number of bins and limits, or an array of edges.
+
+    Same as the edges scipy.stats.binned_statistic would have used.
+    """
+    if np.isscalar(bins):
+        return np.linspace(limits[0], limits[1], int(bins) + 1)
+    return np.asarray(bins, dtype=np.float64)
+
+
+def count(rule, n, digest=None, hist=None, limits=None):
+    """Number of bins over limits chosen by rule for n samples.
+
+    sqrt takes the square root of n, sturges log2(n) + 1, fd the bin width
+    2 IQR/n^(1/3) of Freedman and Diaconis, auto the larger of fd and
+    sturges, and knuth maximises the posterior of Knuth (2006). quantile
+    takes as many bins as auto, see quantiles. For weighted samples n is
+    the effective number of samples.
+
+    fd and auto read the quartiles from the sketch.TDigest digest of the
+    samples within limits, knuth needs hist, a histogram of them in many
+    fine equal bins.
+    """
+    n = max(n, 1.0)
+
+    if rule == 'sqrt':
+        return int(np.floor(n**0.5))
+    if rule == 'sturges':
+        return int(np.ceil(np.log2(n))) + 1
+    if rule == 'knuth':
+        return knuth(hist*n/max(hist.sum(), 1e-300))
+    if rule in ('fd', 'auto', 'quantile'):
+        q1, q3 = digest.quantile([0.25, 0.75])
+        fd = 0
+        if q3 > q1:
+            fd = int(np.ceil((limits[1] - limits[0])/(2.0*(q3 - q1)*n**(-1.0/3))))
+        if rule == 'fd' and fd > 0:
+            return fd
+        return max(fd, count('sturges', n))
+
+    raise ValueError('Unknown binning rule %s, use one of %s.' % (rule, ', '.join(RULES)))
+
+
+def knuth(hist):
+    """Number of equal bins maximising the posterior of Knuth (2006) for the
+    counts hist in many fine equal bins. Coarser histograms are read off
+    the cumulative counts, candidates have at least two fine bins a bin.
+    """
+    n = hist.sum()
+    cum = np.concatenate(([0.0], np.cumsum(hist)))
+    fine = np.arange(hist.shape[0] + 1)
+
+    best, bestlogp = 1, -np.inf
+    for m in range(1, hist.shape[0]//2 + 1):
+        c = np.diff(np.interp(np.linspace(0, hist.shape[0], m + 1), fine, cum))
+        logp = (n*np.log(m) + scipy.special.gammaln(m/2.0) - m*scipy.special.gammaln(0.5)
+                - scipy.special.gammaln(n + m/2.0) + scipy.special.gammaln(c + 0.5).sum())
+        if logp > bestlogp:
+            best, bestlogp = m, logp
+
+    return best
+
+
+def quantiles(nbins, digest, limits):
+    """Edges of at most nbins bins over limits holding equal weight, from the
+    sketch.TDigest digest of the samples within limits. Bins are merged
+    where the weight sits on a single value.
+    """
+    e = np.unique(digest.quantile(np.linspace(0, 1, int(nbins) + 1)))
+    e = e[(e > limits[0]) & (e < limits[1])]
+    return np.concatenate(([limits[0]], e, [limits[1]]))
+
+
+def cap(nbins, itemsize, budget=None):
+    """Scale the numbers of bins along the axes of a grid down alike, so the
+    grid, of items of itemsize bytes, fits in budget bytes, by default
+    BUDGET.
+    """
+    budget = BUDGET if budget is None else budget
+    nbins = [max(int(b), 1) for b in nbins]
+
+    f = (budget/(float(itemsize)*np.prod(nbins, dtype=np.float64)))**(1.0/len(nbins))
+    if f < 1:
+        nbins = [max(int(b*f), 1) for b in nbins]
+    return nbins
+
+
+def index(x, edges):
+    """Bin index of each value in x, -1 for values outside the edges.
+
+    Follows scipy.stats.binned_statistic: bins are half-open [a, b) except
+    the last which is closed [a, b]. NaN falls outside every bin.
+    """
+    nbins = edges.shape[0] - 1
+
+    i = np.searchsorted(edges, x, side='right') - 1
+    i[x == edges[-1]] = nbins - 1
+    i[(i < 0) | (i >= nbins)] = -1
+
+    return i
+
+
+def density(grid, *edges):
+    """The grid divided by the size of its bins relative to the mean size
+    along each axis with unequal bins, the grid itself for equal bins.
+    """
+    for axis, e in enumerate(edges):
+        w = np.diff(e)
+        if not np.allclose(w, w[0], rtol=1e-6, atol=0.0):
+            shape = [1]*grid.ndim
+            shape[axis] = -1
+            grid = grid/(w/w.mean()).reshape(shape)
+    return grid
+
+
+def ravel(ix, iy, ynbins):
+    """Flat bin index into a (xnbins, ynbins) grid from the bin index along
+    each axis, -1 outside the grid.
+    """
+    i = ix*ynbins + iy
+    i[(ix < 0) | (iy < 0)] = -1
+
+    return i
+
+
+def index2d(x, y, xedges, yedges):
+    """Flat bin index into a (xnbins, ynbins) grid, -1 outside the grid."""
+    return ravel(index(x, xedges), index(y, yedges), yedges.shape[0] - 1)
+
+
+def sum(i, w, nbins):
+    """Sum of the weights w in each of the nbins bins given by i."""
+    inside = i >= 0
+    return np.bincount(i[inside], weights=w[inside], minlength=nbins)
+
+
+def add(grid, i, w):
+    """Add the weights w to the bins i of grid, in place, indexing the
+    flattened grid. Only the occupied bins are touched when there are far
+    more bins than weights, so a chunk costs memory of its own size, not
+    that of the grid.
+    """
+    inside = i >= 0
+    i = i[inside]
+    w = w[inside]
+
+    flat = grid.reshape(-1)
+    if flat.shape[0] > 4*i.shape[0]:
+        b, inv = np.unique(i, return_inverse=True)
+        flat[b] += np.bincount(inv, weights=w)
+    else:
+        flat += np.bincount(i, weights=w, minlength=flat.shape[0])
+
+
+def lower(grid, index, i, v, rows):
+    """Lower the minima in grid, in place, to the minima of v in the bins i
+    of the flattened grid, ignoring NaN, and set index to the rows of the
+    values that did. Costs memory of the size of v, not of the grid.
+    """
+    b, pos = _argmin(i, v)
+
+    flat = grid.reshape(-1)
+    better = v[pos] < flat[b]
+    flat[b[better]] = v[pos[better]]
+    index.reshape(-1)[b[better]] = rows[pos[better]]
+
+
+def _argmin(i, v):
+    """The occupied bins and the position in v of the minimum of each."""
+    pos = np.flatnonzero((i >= 0) & ~np.isnan(v))
+
+    # Sort by bin, then by value, the first entry of each bin is its minimum.
+    pos = pos[np.lexsort((v[pos], i[pos]))]
+    b = i[pos]
+    first = np.ones(b.shape[0], dtype=bool)
+    first[1:] = b[1:] != b[:-1]
+
+    return b[first], pos[first]
@@ -0,0 +1,275 @@
+import h5py
+import numpy as np
+import hashlib
+import json
+import os
+import time
+import barrett.util as util
+import barrett.session as session
+
+# Group of the store mapping the arguments of constructions to their grids.
+REQUESTS = 'requests'
+
+# The attributes of a set-up object that identify its grid, see _source.
+_IDENTITY = ('h5file', 'var', 'xvar', 'yvar', 'post_col', 'lnl_col', 'where')
+
+
+class Cache:
+    """ Store of calculated posterior and profile likelihood grids, so that
+    constructing the same plot again does not read the chain.
+
+    The grids and their bin edges are kept in a sidecar HDF5 file, one group
+    per grid, keyed by the chain file, the variables, the weight or
+    likelihood column and the selection, the shape, stored size and version
+    of the data of the columns involved, and the bin edges. When the store
+    holds more than maxentries grids the least recently stored are removed.
+
+    Lookups open the store read-only. A store that cannot be opened, e.g.
+    while another process writes to it, is a miss and a grid that cannot be
+    stored is calculated again next time, so that processes plotting in
+    parallel can share one store.
+
+    A grid that is not in the store is rebinned from a stored grid of the
+    same variables if every one of its bin edges is also an edge of the
+    stored grid, e.g. 60 bins from 120 bins over the same limits.
+
+    A construction with the same arguments as a stored one, see restore, is
+    taken from the store before the statistics and bins of the chain are
+    calculated, so it costs no pass over the data at all.
+    """
+
+    def __init__(self, path, maxentries=100):
+        self.path = path
+        self.maxentries = maxentries
+
+
+    def restore(self, P, request):
+        """Set up and fill P, constructed with the keyword arguments request,
+        from the store, returns whether it could.
+        """
+        if not os.path.isfile(self.path):
+            return False
+
+        for k in _IDENTITY:
+            if k in request:
+                setattr(P, k, request[k])
+
+        try:
+            f = h5py.File(self.path, 'r')
+        except OSError:
+            return False
+        try:
+            r = f.get(REQUESTS + '/' + _request_key(P, request))
+            if r is None or r.attrs['key'] not in f:
+                return False
+
+            g = f[r.attrs['key']]
+            state = json.loads(r.asstr()[()])
+            edges = state.pop('_edges')
+
+            P.__dict__.update(state)
+            for j, name in enumerate(edges):
+                setattr(P, name, g['edges%d' % j][...])
+            for k in P._cached:
+                setattr(P, k, g[k][...])
+            return True
+        finally:
+            f.close()
+
+
+    def load(self, P):
+        """Fill the set-up object P from the store, returns whether it could."""
+        if not os.path.isfile(self.path):
+            return False
+
+        try:
+            f = h5py.File(self.path, 'r')
+        except OSError:
+            return False
+        try:
+            key = _key(P)
+            if key in f:
+                g = f[key]
+                for k in P._cached:
+                    setattr(P, k, g[k][...])
+            else:
+                g = self._finer(f, P)
+                if g is None:
+                    return False
+                _rebin(P, g)
+            return True
+        finally:
+            f.close()
+
+
+    def store(self, P):
+        """Store the grids of the filled, not yet finalised, object P."""
+        try:
+            f = h5py.File(self.path, 'a')
+        except OSError:
+            # opened, or being created, by another process
+            return
+        try:
+            key = _key(P)
+            if key in f:
+                del f[key]
+
+            g = f.create_group(key)
+            g.attrs['source'] = _source(P)
+            g.attrs['atime'] = time.time()
+            for j, e in enumerate(_edges(P)):
+                g['edges%d' % j] = e
+            for k in P._cached:
+                g[k] = getattr(P, k)
+
+            request = getattr(P, '_request', None)
+            if request is not None:
+                self._record(f, P, request, key)
+
+            groups = sorted(_grids(f), key=lambda g: g.attrs['atime'])
+            for g in groups[:max(len(groups) - self.maxentries, 0)]:
+                del f[g.name]
+
+            if REQUESTS in f:
+                r = f[REQUESTS]
+                for k in [k for k, v in r.items() if v.attrs['key'] not in f]:
+                    del r[k]
+        finally:
+            f.close()
+
+
+    def _record(self, f, P, request, key):
+        """Store that constructing with request sets P up as it is, with the
+        grid stored under key.
+        """
+        skip = set(('h5file', '_request') + P._cached + tuple(_edgenames(P)))
+        state = {k: v for k, v in P.__dict__.items() if k not in skip}
+        state['_edges'] = _edgenames(P)
+
+        r = f.require_group(REQUESTS)
+        name = _request_key(P, request)
+        if name in r:
+            del r[name]
+        # a dataset, attributes are limited to 64 kB and bins may be edges
+        d = r.create_dataset(name, data=json.dumps(state, default=_plain))
+        d.attrs['key'] = key
+
+
+    def _finer(self, f, P):
+        """A stored grid P can be rebinned from, or None."""
+        source = _source(P)
+        edges = _edges(P)
+
+        for g in _grids(f):
+            if g.attrs['source'] != source:
+                continue
+            if all(_subedges(e, g['edges%d' % j][...]) is not None
+                   for j, e in enumerate(edges)):
+                return g
+
+        return None
+
+
+def _grids(f):
+    return [g for k, g in f.items() if k != REQUESTS]
+
+
+def _edgenames(P):
+    return ['bin_edges'] if hasattr(P, 'bin_edges') else ['xbin_edges', 'ybin_edges']
+
+
+def _edges(P):
+    return [getattr(P, k) for k in _edgenames(P)]
+
+
+def _plain(o):
+    """o, a numpy scalar or array, as JSON."""
+    return o.tolist()
+
+
+def _request_key(P, request):
+    """Identifies the construction of P with the keyword arguments request."""
+    args = {k: v for k, v in request.items() if k != 'h5file'}
+    h = hashlib.sha1(_source(P).encode())
+    h.update(json.dumps(args, sort_keys=True, default=_plain).encode())
+    return h.hexdigest()
+
+
+def _source(P):
+    """Everything but the bin edges that identifies the grid of P."""
+    names = [getattr(P, v) for v in ('var', 'xvar', 'yvar', 'post_col', 'lnl_col')
+             if hasattr(P, v)]
+
+    where = getattr(P, 'where', None)
+
+    h5 = session.h5open(P.h5file, 'r')
+    if where is not None:
+        names += util.selection(h5, where)[1]
+    fingerprints = [_fingerprint(h5, k) for k in names]
+    h5.close()
+
+    return json.dumps([os.path.realpath(P.h5file), type(P).__module__, type(P).__name__,
+                       names, where, fingerprints])
+
+
+def _fingerprint(h5, name):
+    """Changes whenever the data of the column does: its version is random
+    and renewed by every write, see util.stamp. Unlike the modification time
+    of the file it does not change when statistics are cached.
+    """
+    c = util.column(h5, name)
+
+    if isinstance(c, util.VirtualColumn):
+        return [c.expr] + [_fingerprint(h5, a) for a in c.args]
+
+    d = c.block if isinstance(c, util.BlockColumn) else c
+    version = c.attrs.get('barrett.version')
+    if version is None:
+        # written by something else, any change of the file
+        version = os.stat(h5.filename).st_mtime_ns
+    return [d.name, list(d.shape), int(d.id.get_storage_size()), str(version)]
+
+
+def _key(P):
+    h = hashlib.sha1(_source(P).encode())
+    for e in _edges(P):
+        h.update(np.ascontiguousarray(e, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def _subedges(edges, fine):
+    """Positions of edges among the fine edges, None if not all are there."""
+    i = np.clip(np.searchsorted(fine, edges), 0, fine.shape[0] - 1)
+    j = np.clip(i - 1, 0, fine.shape[0] - 1)
+    i = np.where(np.abs(fine[j] - edges) < np.abs(fine[i] - edges), j, i)
+
+    if not np.allclose(fine[i], edges, rtol=1e-9, atol=0.0):
+        return None
+    return i
+
+
+def _rebin(P, g):
+    """Fill P by merging the fine bins of the stored grid g."""
+    arrays = {k: g[k][...] for k in P._cached}
+
+    for axis, e in enumerate(_edges(P)):
+        i = _subedges(e, g['edges%d' % axis][...])
+        segments = [np.arange(a, b) for a, b in zip(i[:-1], i[1:])]
+
+        if 'pdf' in arrays:
+            arrays['pdf'] = np.stack([arrays['pdf'].take(s, axis=axis).sum(axis=axis)
+                                      for s in segments], axis=axis)
+        else:
+            chisq = []
+            index = []
+            for s in segments:
+                c = arrays['chisq'].take(s, axis=axis)
+                b = np.expand_dims(np.argmin(c, axis=axis), axis)
+                chisq.append(np.take_along_axis(c, b, axis).squeeze(axis))
+                index.append(np.take_along_axis(arrays['bestfit_index'].take(s, axis=axis),
+                                                b, axis).squeeze(axis))
+            arrays['chisq'] = np.stack(chisq, axis=axis)
+            arrays['bestfit_index'] = np.stack(index, axis=axis)
+
+    for k, v in arrays.items():
+        setattr(P, k, v)
@@ -1,134 +1,489 @@
 import h5py
 import numpy as np
 import os.path
+import json
+import heapq
+import barrett.util as util
+import barrett.profiling as profiling
+import barrett.session as session
+
+# Most best fit rows cached, HDF5 attributes are limited to 64 kB.
+BESTFIT = 1000
 
 class Chain:
 
-    def __init__(self, h5file, chunksize=10000):
+    def __init__(self, h5file, chunksize=10000, compression='gzip'):
         self.h5file = h5file
 
         if not os.path.isfile(self.h5file):
             f = h5py.File(self.h5file, 'w')
             self.chunksize = chunksize
+            self.compression = compression
             self.n = 0
+            f.attrs['barrett.compression'] = compression or 'none'
 
         else:
-            f = h5py.File(self.h5file, 'r')
-            col = tuple(f.keys())[0]
-            self.chunksize = f[col].chunks[0]
-            self.n = f[col].shape[0]
+            f = session.h5open(self.h5file, 'r')
+            col = util.column(f, util.names(f)[0])
+            self.chunksize = util.readsize(col)
+            self.compression = f.attrs.get('barrett.compression', 'gzip')
+            self.n = col.shape[0]
 
         f.close()
 
 
     def create_column(self, name):
-        h5 = h5py.File(self.h5file, 'r+')
+        h5 = session.h5open(self.h5file, 'r+')
 
         h5.create_dataset(name,
                           shape=(self.n,),
                           maxshape=(None,),
                           dtype=np.float64,
                           chunks=(self.chunksize,),
-                          compression='gzip',
-                          shuffle=True)
+                          **util.storage(self.compression))
+        util.stamp(h5, name)
 
         h5.close()
 
 
     def apply(self, d_name, func, *args):
-        h5 = h5py.File(self.h5file, 'r+')
+        self.derive({d_name: (func,) + args})
+
+
+    @profiling.operation
+    def derive(self, columns, threads=None):
+        """Calculate several columns in a single pass over the data.
+
+        columns maps the name of each new, or overwritten, column to either
+        a tuple (func, arg1, arg2, ...), where func is called with a chunk
+        of each of the named columns as in apply, or an expression string
+        such as 'log10(C_1)' (see util.expression). Expressions are
+        evaluated by numexpr on threads threads, if it is installed.
+
+        Each chunk of every input column is read once, and every column is
+        calculated from the data as it was before the call. The zone maps of
+        the columns (see util.zones) are written along the way.
+        """
+        h5 = session.h5open(self.h5file, 'r+')
+
+        names = util.names(h5)
+
+        funcs = {}
+        for d_name, c in columns.items():
+            if isinstance(c, str):
+                expr, args = util.expression(c, names)
+                funcs[d_name] = (lambda *v, expr=expr: util.evaluate(expr, v), args)
+            else:
+                funcs[d_name] = (c[0], list(c[1:]))
+
+        inputs = []
+        for func, args in funcs.values():
+            inputs += [a for a in args if a not in inputs]
+
+        if not inputs:
+            h5.close()
+            raise ValueError('The columns depend on no other columns.')
+
+        # the zone maps of the outputs are weighted like those in the file
+        post_col = None
+        if util.ZONES in h5:
+            cols = [z.attrs['post_col'] for z in h5[util.ZONES].values()]
+            if cols and cols[0] in names and cols[0] not in columns:
+                post_col = cols[0]
+        reads = inputs + [post_col] if post_col not in inputs + [None] else inputs
+
+        virtual = util.virtual(h5)
+        for d_name in columns:
+            if d_name in virtual and d_name in inputs:
+                h5.close()
+                raise ValueError('Materialize the virtual column %s before deriving it from itself.'
+                                 % d_name)
+
+        outputs = {}
+        for d_name in columns:
+            if not util.copies(h5, d_name):
+                self.create_column(d_name)
+            outputs[d_name] = util.copies(h5, d_name)
+
+        if threads is not None and util.numexpr is not None:
+            threads = util.numexpr.set_num_threads(threads)
+
+        zones = {d_name: [] for d_name in columns}
+
+        try:
+            # all outputs of a chunk are calculated before any is written,
+            # an output may also be an input
+            for i, vs in util.chunks(h5, reads):
+                v = dict(zip(reads, vs))
+                vals = {d_name: func(*[v[a] for a in args])
+                        for d_name, (func, args) in funcs.items()}
+                for d_name, val in vals.items():
+                    for d in outputs[d_name]:
+                        d[i:i+len(vs[0])] = val
+                    val = np.broadcast_to(val, vs[0].shape)
+                    zones[d_name].append(util.zone(val, v.get(post_col)))
+        finally:
+            if threads is not None and util.numexpr is not None:
+                util.numexpr.set_num_threads(threads)
+
+        for d_name in columns:
+            util.clear_stats(h5, d_name)
+
+        chunksize = util.readsize(util.column(h5, reads[0]))
+        for d_name, z in zones.items():
+            z = np.array(z, dtype=np.float64).reshape(-1, len(util.ZONE))
+            util.store_zones(h5, d_name, z, chunksize, post_col or '')
+
+        # a derived column replaces a virtual column of the same name
+        if any(d_name in virtual for d_name in columns):
+            h5.attrs[util.VIRTUAL] = json.dumps({k: e for k, e in virtual.items()
+                                                 if k not in columns})
+
+        h5.close()
 
-        if d_name not in h5:
-            self.create_column(d_name)
 
-        d = h5[d_name]
+    def virtual(self, name, expr):
+        """Add a virtual column, calculated from the expression expr (see
+        util.expression) whenever it is read instead of stored on disk.
 
-        vs = [h5[i] for i in args]
+        Only the expression is stored in the file. Readers of the file
+        calculate the column chunk by chunk, which is cheaper than reading
+        it for simple expressions such as 'log10(x)'.
+        """
+        h5 = session.h5open(self.h5file, 'r+')
 
-        s = self.chunksize
+        virtual = util.virtual(h5)
+        if name in util.names(h5) and name not in virtual:
+            h5.close()
+            raise ValueError('Column %s already exists.' % name)
 
-        for i in range(0, self.n, s):
-            val = func(*[v[i:i+s] for v in vs])
-            d[i:i+s] = val
+        virtual[name] = expr
+        try:
+            # before it is stored, also if it redefines a column others use
+            util.dependencies(h5, virtual, name)
+            util.VirtualColumn(h5, name, expr)
+        except Exception:
+            h5.close()
+            raise
+
+        h5.attrs[util.VIRTUAL] = json.dumps(virtual)
+        util.clear_stats(h5, name)
 
         h5.close()
 
 
+    def materialize(self, names=None):
+        """Calculate and store virtual columns, by default all, as ordinary
+        columns in a single pass over the data.
+        """
+        h5 = session.h5open(self.h5file, 'r')
+        virtual = util.virtual(h5)
+        h5.close()
+
+        names = list(virtual) if names is None else names
+        if names:
+            self.derive({k: virtual[k] for k in names})
+
+
     def transform_column(self, column, func):
         self.apply(column, func, column)
 
 
-    def append(self, other):
-        h5 = h5py.File(self.h5file, 'r+')
+    @profiling.operation
+    def append(self, *others):
+        """Append the rows of one or more other chains, Chain objects or
+        paths, with the same columns.
+
+        Every dataset is resized once. Where a dataset has the same dtype,
+        chunk shape and filters in both files and the appended rows start at
+        a chunk boundary, the compressed chunks are copied as they are,
+        without decompressing them. Otherwise the rows are copied a chunk at
+        a time. The zone maps (see util.zones) are joined if every chain
+        but the last ends at a chunk boundary.
+        """
+        files = [o.h5file if isinstance(o, Chain) else o for o in others]
+
+        h5 = session.h5open(self.h5file, 'r+')
+        other_h5s = [session.h5open(f, 'r') for f in files]
+
+        try:
+            for other_h5 in other_h5s:
+                sym_diff_keys = set(_stored(h5)) ^ set(_stored(other_h5))
+                if len(_stored(h5)) != 0 and len(sym_diff_keys) != 0:
+                    raise ValueError('Not compatible datasets. Symmetric difference: %s'
+                                     % sym_diff_keys)
+                if util.BLOCK in h5 and (list(h5[util.BLOCK].attrs['barrett.columns'])
+                                         != list(other_h5[util.BLOCK].attrs['barrett.columns'])):
+                    raise ValueError('Not compatible datasets. Different block columns.')
+
+            if len(_stored(h5)) == 0 and other_h5s:
+                for k in _stored(other_h5s[0]):
+                    d = other_h5s[0][k]
+                    if d.chunks is None:
+                        # contiguous datasets cannot grow
+                        x = h5.create_dataset(k,
+                                              shape=(0,) + d.shape[1:],
+                                              maxshape=(None,) + d.shape[1:],
+                                              dtype=d.dtype,
+                                              chunks=(self.chunksize,) + d.shape[1:],
+                                              **util.storage(self.compression))
+                    else:
+                        x = h5.create_dataset_like(k, d, shape=(0,) + d.shape[1:])
+                    if k == util.BLOCK:
+                        x.attrs['barrett.columns'] = d.attrs['barrett.columns']
+
+            zones = _append_zones([h5] + other_h5s)
+
+            for k in _stored(h5):
+                d = h5[k]
+                nrows = d.shape[0]
+                d.resize(nrows + sum(o[k].shape[0] for o in other_h5s), axis=0)
+
+                for other_h5 in other_h5s:
+                    src = other_h5[k]
+                    if not _copy_chunks(src, d, nrows):
+                        src = util.mapped(src)
+                        step = d.chunks[0]
+                        for i in range(0, src.shape[0], step):
+                            e = min(i+step, src.shape[0])
+                            d[nrows+i:nrows+e] = src[i:e]
+                    nrows += src.shape[0]
+
+            for k in util.names(h5):
+                util.clear_stats(h5, k)
+
+            for k, (z, chunksize, post_col) in zones.items():
+                util.store_zones(h5, k, z, chunksize, post_col)
+
+            if len(_stored(h5)) != 0:
+                self.n = util.column(h5, util.names(h5)[0]).shape[0]
+
+        finally:
+            h5.close()
+            for other_h5 in other_h5s:
+                other_h5.close()
+
+
+    @profiling.operation
+    def bestfit(self, lnl_col='-2lnL', k=None, where=None):
+        """The best fit point, the row with the lowest lnl_col, as a
+        dictionary of the value of every column. With k the k best points,
+        best first, as a dictionary of arrays.
+
+        The rows are found in a single pass over lnl_col, keeping the best
+        so far in a heap, and up to BESTFIT of them cached as an attribute of
+        lnl_col, so asking again costs one read per column. Writing lnl_col
+        drops the cache.
+        The best fit among the rows selected by where (see util.select) is
+        not cached.
+        """
+        n = 1 if k is None else k
+
+        h5 = session.h5open(self.h5file, 'r')
+        rows = util.column(h5, lnl_col).attrs.get('barrett.bestfit')
+        cached = where is None and rows is not None and len(rows) >= min(n, self.n)
+        h5.close()
+
+        if where is not None:
+            rows = self._bestrows(lnl_col, n, where)
+        elif not cached:
+            rows = self._bestrows(lnl_col, n)
 
-        other_h5 = h5py.File(self.h5file, 'r')
+            try:
+                h5 = session.h5open(self.h5file, 'r+') if n <= BESTFIT else None
+            except OSError:
+                # read-only or opened by someone else, search again next time
+                h5 = None
+            if h5 is not None:
+                util.column(h5, lnl_col).attrs['barrett.bestfit'] = rows
+                h5.close()
 
-        sym_diff_keys = set(h5.keys()) ^ set(other_h5.keys())
-        if len(sym_diff_keys) != 0:
-            print('Not compatible datasets. Symmetric difference: %s\n' % sym_diff_keys)
-            return
+        rows = np.asarray(rows[:n], dtype=np.int64)
 
-        col = tuple(other_h5.keys())[0]
-        other_n = other_h5[col].shape[0]
+        # h5py reads only increasing rows
+        order = np.argsort(rows)
+        inverse = np.argsort(order)
 
-        starts = list(range(0, other_n, self.chunksize))
-        ends   = starts[1:] + [other_n]
+        h5 = session.h5open(self.h5file, 'r')
+        p = {}
+        for c in util.names(h5):
+            p[c] = util.column(h5, c)[list(rows[order])][inverse]
+        h5.close()
 
-        for s, e in zip(starts, ends):
-            for k in other_h5.keys():
-                other_nrows = e-s
+        if k is None:
+            p = {c: v[0] for c, v in p.items()}
+        return p
 
-                nrows = h5[k].shape[0]
 
-                h5[k].resize(nrows+other_nrows, axis=0)
+    def _bestrows(self, lnl_col, n, where=None):
+        """The rows of the n lowest values of lnl_col, lowest first."""
+        h5 = session.h5open(self.h5file, 'r')
 
-                h5[k][nrows:] = other_h5[k][s:e]
+        # max-heap, by negated value, of the best n so far
+        heap = []
+        for rows, (chi2,) in util.select(h5, [lnl_col], where):
+            chi2 = np.where(np.isnan(chi2), np.inf, chi2)
 
-        col = tuple(h5.keys())[0]
-        self.n = h5[col].shape[0]
+            # only the n best of a chunk can enter the heap
+            best = np.argpartition(chi2, n-1)[:n] if chi2.shape[0] > n else np.arange(chi2.shape[0])
+            for j in best:
+                item = (-chi2[j], -rows[j])
+                if len(heap) < n:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
 
         h5.close()
-        other_h5.close()
 
+        return np.array([-r for v, r in sorted(heap, reverse=True)], dtype=np.int64)
 
-    def bestfit(self):
 
-        h5 = h5py.File(self.h5file, 'r')
-        chi2 = h5['-2lnL']
-        s = self.chunksize
+    def posterior_mean(self, post_col='mult', columns=None, where=None):
+        m = self.moments(columns, order=1, post_col=post_col, where=where)
+        return dict(zip(m['columns'], m['mean']))
 
-        minimum, index = (chi2[0], 0)
-        for i in range(0, self.n, s):
-            chunk_index = np.argmin(chi2)
-            chunk_minimum = chi2[chunk_index]
 
-            if chunk_minimum < minimum:
-                minimum = chunk_minimum
-                index = chunk_index
+    @profiling.operation
+    def moments(self, columns=None, order=2, post_col='mult', where=None):
+        """Posterior mean, and with order 2 variance and covariance matrix,
+        of the columns, by default all but post_col, in a single pass.
 
-        p = {}
-        for k in h5.keys():
-            p[k] = h5[k][index]
-        return p
+        Each chunk of the weights is read once and the columns are stacked
+        into one 2D block. The moments of each chunk are combined with those
+        so far by the pairwise update of Chan, Golub and LeVeque, which is
+        numerically stable. The mean and variance of each column ignore its
+        own non-finite values, the covariance matrix the rows with any
+        non-finite value. Rows not selected by where, see util.select, are
+        ignored.
 
+        Returns a dictionary with the list of columns, the weight sums wsum
+        of the finite values of each column, the mean and, with order 2, var
+        and the (ncols, ncols) matrix cov. Moments without any finite value,
+        or weight, are NaN.
+        """
+        h5 = session.h5open(self.h5file, 'r')
 
-    def posterior_mean(self, post_col='mult', columns=None):
-        h5 = h5py.File(self.h5file, 'r')
-        s = self.chunksize
+        if columns is None:
+            columns = [c for c in util.names(h5) if c != post_col]
+        columns = list(columns)
+        p = len(columns)
 
-        p = {}
-        for k in h5.keys():
-            p[k] = 0.0
+        # per column
+        wsum = np.zeros(p)
+        mean = np.zeros(p)
+        M2 = np.zeros(p)
 
-        for i in range(0, self.n, s):
-            for k in h5.keys():
-                p[k] += np.sum(h5[post_col][i:i+s]*h5[k][i:i+s])
-        return p
+        # of the rows where every column is finite
+        wjoint = 0.0
+        mjoint = np.zeros(p)
+        Cjoint = np.zeros((p, p))
+
+        for rows, cols in util.select(h5, [post_col] + columns, where):
+            w = cols[0]
+            X = np.column_stack(cols[1:])
+
+            finite = np.isfinite(X) & np.isfinite(w)[:, np.newaxis]
+            Wc = np.where(finite, w[:, np.newaxis], 0.0)
+            X0 = np.where(finite, X, 0.0)
+
+            wb = Wc.sum(axis=0)
+            some = wb != 0
+            meanb = np.divide((Wc*X0).sum(axis=0), wb, out=np.zeros(p), where=some)
+            delta = meanb - mean
+            W = wsum + wb
+            f = np.divide(wb, W, out=np.zeros(p), where=some)
+
+            mean += delta*f
+            if order >= 2:
+                M2 += (Wc*(X0 - meanb)**2).sum(axis=0) + delta**2*wsum*f
+            wsum = W
+
+            if order < 2:
+                continue
+
+            good = finite.all(axis=1)
+            w = w[good]
+            X = X[good]
+
+            wb = w.sum()
+            if wb == 0:
+                continue
+
+            meanb = np.dot(w, X)/wb
+            delta = meanb - mjoint
+            W = wjoint + wb
+
+            mjoint += delta*(wb/W)
+            D = X - meanb
+            Cjoint += np.dot(D.T, D*w[:, np.newaxis]) + np.outer(delta, delta)*(wjoint*wb/W)
+
+            wjoint = W
+
+        h5.close()
+
+        none = wsum == 0
+        m = {'columns': columns, 'wsum': wsum, 'mean': np.where(none, np.nan, mean)}
+        if order >= 2:
+            m['var'] = np.where(none, np.nan, M2/np.where(none, 1.0, wsum))
+            m['cov'] = Cjoint/wjoint if wjoint != 0 else np.full((p, p), np.nan)
+        return m
 
 
     def log(self, column):
-        h5 = h5py.File(self.h5file, 'r+')
+        h5 = session.h5open(self.h5file, 'r+')
 
         self.apply('log(%s)' % column, np.log10, column)
 
         h5.close()
+
+
+def _copy_chunks(src, dst, offset):
+    """Copy the compressed chunks of src into dst starting at row offset,
+    if their storage is identical and offset is at a chunk boundary.
+    Returns whether the chunks were copied.
+    """
+    if (src.dtype != dst.dtype or src.chunks != dst.chunks
+            or src._filters != dst._filters or offset % dst.chunks[0] != 0
+            or not hasattr(src.id, 'get_chunk_info')):
+        return False
+
+    for j in range(src.id.get_num_chunks()):
+        info = src.id.get_chunk_info(j)
+        mask, chunk = src.id.read_direct_chunk(info.chunk_offset)
+        dst.id.write_direct_chunk((info.chunk_offset[0] + offset,) + info.chunk_offset[1:],
+                                  chunk, mask)
+
+    return True
+
+
+def _stored(h5):
+    """Names of the datasets of the columns in the file."""
+    return [k for k in h5.keys() if k != util.ZONES]
+
+
+def _append_zones(h5s):
+    """The zone maps of the chains h5s appended in order, by column, where
+    every chain has an up to date one with the same chunks and weights.
+    """
+    ref = [h5 for h5 in h5s if util.ZONES in h5]
+    if not ref:
+        return {}
+
+    zones = {}
+    for k, z in ref[0][util.ZONES].items():
+        chunksize = z.attrs['chunksize']
+        post_col = z.attrs['post_col']
+
+        parts = []
+        for j, h5 in enumerate(h5s):
+            n = util.column(h5, k).shape[0] if k in util.names(h5) else -1
+            p = util.zones(h5, k, chunksize) if n > 0 else np.zeros((0, len(util.ZONE)))
+            if (n < 0 or p is None or (j < len(h5s) - 1 and n % chunksize != 0)
+                    or (n > 0 and h5[util.ZONES][k].attrs['post_col'] != post_col)):
+                break
+            parts.append(p)
+        else:
+            zones[k] = (np.concatenate(parts), chunksize, post_col)
+
+    return zones
+
@@ -2,45 +2,99 @@
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
-import scipy.stats as stats
-from scipy.optimize import brentq
-import h5py
 import barrett.util as util
+import barrett.profiling as profiling
+import barrett.session as session
+import barrett.binning as binning
+
+def credible_levels(pdf, probs, mass=None):
+    """ The levels of the highest density regions of pdf holding the
+    probabilities probs, in the units of pdf, which need not be normalised.
+    mass is the probability in each bin, pdf itself for equal bins.
+
+    The grid is sorted once, then every level is read off the cumulative
+    sum of the sorted grid.
+    """
+    order = np.argsort(pdf, axis=None)[::-1]
+    p = pdf.reshape(-1)[order]
+    c = np.cumsum(p if mass is None else mass.reshape(-1)[order])
+    i = np.searchsorted(c, np.asarray(probs)*c[-1])
+    return p[np.minimum(i, p.shape[0] - 1)]
+
 
 class oneD:
     """ Calculate and plot the one dimensional marginalised posteriors.
+
+    workers, cache, where, bins and budget are those of every grid, see
+    util.scan.
     """
-    def __init__(self, h5file, var, limits=None, bins=None, post_col='mult'):
+
+    _cached = ('pdf',)
+
+
+    @profiling.operation
+    def __init__(self, h5file, var, limits=None, bins=None, post_col='mult',
+                 workers=None, cache=None, where=None, budget=None):
+
+        cache, restored = util.restore(self, cache, h5file=h5file, var=var, limits=limits,
+                                       bins=bins, post_col=post_col, where=where,
+                                       budget=budget)
+        if not restored:
+            self._setup(h5file, var, limits, bins, post_col,
+                        None if limits is not None else
+                        util.threenum(h5file, var, post_col, where=where), where, budget)
+            util.scan(self, workers, cache)
+
+
+    def _setup(self, h5file, var, limits, bins, post_col, threenum, where=None, budget=None):
 
         self.h5file = h5file
         self.var = var
+        self.post_col = post_col
+        self.where = where
 
-        h5 = h5py.File(h5file, 'r')
+        h5 = session.h5open(h5file, 'r')
 
-        self.n = h5[self.var].shape[0]
-        self.name = h5[self.var].name
-        self.chunksize = h5[self.var].chunks[0]
+        self.n = util.column(h5, self.var).shape[0]
+        self.name = util.column(h5, self.var).name
+        self.chunksize = util.readsize(util.column(h5, self.var))
+
+        h5.close()
 
-        self.min, self.max, self.mean = util.threenum(self.h5file, self.var)
-        self.bins = np.floor(self.n**0.5) if bins is None else bins
-        self.nbins = self.bins if np.isscalar(self.bins) else self.bins.shape[0]
+        # only calculated without limits
+        self.min, self.max, self.mean = threenum or (None, None, None)
         self.limits = (self.min, self.max) if limits is None else limits
 
+        self.bin_edges, = util.binedges(h5file, [var], [self.limits], [bins], post_col, where,
+                                        8, budget)
+        self.nbins = self.bin_edges.shape[0] - 1
+        self.bins = self.nbins if bins is None else bins
+
         self.pdf = np.zeros(self.nbins)
-        s = self.chunksize
-        for i in range(0, self.n, s):
-            r = stats.binned_statistic(h5[self.var][i:i+s],
-                                       h5[post_col][i:i+s],
-                                       'sum',
-                                       bins=self.bins,
-                                       range=self.limits)
-            self.pdf += r.statistic
 
-        self.bin_edges  = r.bin_edges
 
+    def _scan(self, start, stop):
+        h5 = session.h5open(self.h5file, 'r')
+        ranges = {self.var: (self.bin_edges[0], self.bin_edges[-1])}
+        for rows, (x, w) in util.select(h5, [self.var, self.post_col], self.where, start, stop,
+                                        ranges):
+            self._fill(x, w)
         h5.close()
 
 
+    def _fill(self, x, w):
+        self._add(binning.index(x, self.bin_edges), w)
+
+
+    def _add(self, i, w):
+        binning.add(self.pdf, i, w)
+
+
+    def _merge(self, other):
+        self.pdf += other.pdf
+
+
+    @profiling.operation
     def plot(self, ax, **hist_kwargs):
 
         defaults = {
@@ -50,70 +104,146 @@ class oneD:
         }
         defaults.update(hist_kwargs)
 
+        pdf = binning.density(self.pdf, self.bin_edges)
+
         ax.hist(self.bin_edges[:-1],
                  bins=self.bin_edges,
-                 weights=self.pdf,
+                 weights=pdf,
                  **defaults)
 
-        ax.set_ylim(0, self.pdf.max()*1.1)
+        ax.set_ylim(0, pdf.max()*1.1)
         ax.set_xlabel('%s' % (self.name))
 
 
+    def credibleregions(self, probs):
+        """ Calculates the credible regions, see twoD.credibleregions.
+        """
+
+        return credible_levels(binning.density(self.pdf, self.bin_edges), probs, self.pdf)
+
+
+    def hdi(self, probs):
+        """ Calculates the highest density intervals.
+
+        Returns for each probability the list of (lower, upper) intervals,
+        at bin edges, where the pdf is at least its credible level.
+        """
+
+        pdf = binning.density(self.pdf, self.bin_edges)
+
+        intervals = []
+        for l in self.credibleregions(probs):
+            inside = np.concatenate(([False], pdf >= l, [False]))
+            edges = np.flatnonzero(inside[1:] != inside[:-1])
+            intervals.append([(self.bin_edges[a], self.bin_edges[b])
+                              for a, b in zip(edges[::2], edges[1::2])])
+        return intervals
+
+
 class twoD:
     """ Calculate and plot the two dimensional marginalised posteriors.
+
+    workers, cache, where, bins and budget are those of every grid, see
+    util.scan.
     """
 
-    def __init__(self, h5file, xvar, yvar, xlimits=None, ylimits=None, xbins=None, ybins=None, post_col='mult'):
+    _cached = ('pdf',)
+
+
+    @profiling.operation
+    def __init__(self, h5file, xvar, yvar, xlimits=None, ylimits=None, xbins=None, ybins=None, post_col='mult',
+                 workers=None, cache=None, where=None, budget=None):
+
+        cache, restored = util.restore(self, cache, h5file=h5file, xvar=xvar, yvar=yvar,
+                                       xlimits=xlimits, ylimits=ylimits, xbins=xbins,
+                                       ybins=ybins, post_col=post_col, where=where,
+                                       budget=budget)
+        if not restored:
+            t = util.threenums(h5file, [v for v, l in ((xvar, xlimits), (yvar, ylimits))
+                                 if l is None], post_col, where=where)
+            self._setup(h5file, xvar, yvar, xlimits, ylimits, xbins, ybins, post_col,
+                        t.get(xvar), t.get(yvar), where, budget)
+            util.scan(self, workers, cache)
+
+        self._finalise()
+
+
+    def _setup(self, h5file, xvar, yvar, xlimits, ylimits, xbins, ybins, post_col,
+               xthreenum, ythreenum, where=None, budget=None):
 
         self.h5file = h5file
         self.xvar = xvar
         self.yvar = yvar
+        self.post_col = post_col
+        self.where = where
 
-        h5 = h5py.File(h5file, 'r')
+        h5 = session.h5open(h5file, 'r')
 
-        self.n = h5[self.xvar].shape[0]
-        self.chunksize = h5[self.xvar].chunks[0]
-        self.xname = h5[self.xvar].name
-        self.yname = h5[self.yvar].name
+        self.n = util.column(h5, self.xvar).shape[0]
+        self.chunksize = util.readsize(util.column(h5, self.xvar))
+        self.xname = util.column(h5, self.xvar).name
+        self.yname = util.column(h5, self.yvar).name
 
-        self.xmin, self.xmax, self.xmean = util.threenum(self.h5file, self.xvar)
-        self.ymin, self.ymax, self.ymean = util.threenum(self.h5file, self.yvar)
+        h5.close()
+
+        # only calculated without limits
+        self.xmin, self.xmax, self.xmean = xthreenum or (None, None, None)
+        self.ymin, self.ymax, self.ymean = ythreenum or (None, None, None)
 
-        self.xbins = np.floor(self.n**0.5) if xbins is None else xbins
-        self.xnbins = self.xbins if np.isscalar(self.xbins) else self.xbins.shape[0] - 1
-        self.ybins = np.floor(self.n**0.5) if ybins is None else ybins
-        self.ynbins = self.ybins if np.isscalar(self.ybins) else self.ybins.shape[0] - 1
         self.xlimits = (self.xmin, self.xmax) if xlimits is None else xlimits
         self.ylimits = (self.ymin, self.ymax) if ylimits is None else ylimits
 
+        self.xbin_edges, self.ybin_edges = util.binedges(h5file, [xvar, yvar],
+                                                         [self.xlimits, self.ylimits],
+                                                         [xbins, ybins], post_col, where,
+                                                         8, budget)
+        self.xnbins = self.xbin_edges.shape[0] - 1
+        self.ynbins = self.ybin_edges.shape[0] - 1
+        self.xbins = self.xnbins if xbins is None else xbins
+        self.ybins = self.ynbins if ybins is None else ybins
+
         self.pdf = np.zeros((self.xnbins, self.ynbins))
-        s = self.chunksize
-        for i in range(0, self.n, s):
-            r = stats.binned_statistic_2d(h5[self.xvar][i:i+s],
-                                          h5[self.yvar][i:i+s],
-                                          h5[post_col][i:i+s],
-                                          'sum',
-                                          bins=(self.xbins, self.ybins),
-                                          range=[self.xlimits, self.ylimits])
-            self.pdf += r.statistic
+
+
+    def _scan(self, start, stop):
+        h5 = session.h5open(self.h5file, 'r')
+        ranges = {self.xvar: (self.xbin_edges[0], self.xbin_edges[-1]),
+                  self.yvar: (self.ybin_edges[0], self.ybin_edges[-1])}
+        for rows, (x, y, w) in util.select(h5, [self.xvar, self.yvar, self.post_col], self.where,
+                                           start, stop, ranges):
+            self._fill(x, y, w)
+        h5.close()
+
+
+    def _fill(self, x, y, w):
+        self._add(binning.index2d(x, y, self.xbin_edges, self.ybin_edges), w)
+
+
+    def _add(self, i, w):
+        binning.add(self.pdf, i, w)
+
+
+    def _merge(self, other):
+        self.pdf += other.pdf
+
+
+    def _finalise(self):
         self.pdf = self.pdf.T
 
-        self.xbin_edges  = r.x_edge
-        self.ybin_edges  = r.y_edge
         self.xcenters = self.xbin_edges[:-1] + np.diff(self.xbin_edges)/2.0
         self.ycenters = self.ybin_edges[:-1] + np.diff(self.ybin_edges)/2.0
 
-        h5.close()
-
 
+    @profiling.operation
     def plot(self, ax, levels=[0.95, 0.68], cmap=None, **contourf_kwargs):
 
         X, Y = np.meshgrid(self.xcenters, self.ycenters)
+        pdf = binning.density(self.pdf, self.ybin_edges, self.xbin_edges)
 
         if levels is None:
-            levels = np.linspace(0, self.pdf.max(), 10)[1:]
+            levels = np.linspace(0, pdf.max(), 10)[1:]
         else:
-            levels = np.append(self.credibleregions(levels), self.pdf.max())
+            levels = np.append(self.credibleregions(levels), pdf.max())
 
         if cmap is None:
             cmap = matplotlib.cm.gist_heat_r
@@ -125,7 +255,7 @@ class twoD:
         }
         defaults.update(contourf_kwargs)
 
-        ax.contourf(X, Y, self.pdf, levels=levels, **defaults)
+        ax.contourf(X, Y, pdf, levels=levels, **defaults)
 
         ax.set_xlabel('%s' % (self.xname))
         ax.set_ylabel('%s' % (self.yname))
@@ -133,6 +263,92 @@ class twoD:
 
     def credibleregions(self, probs):
         """ Calculates the credible regions.
+
+        Returns the level of the pdf enclosing each probability, the region
+        where the pdf is at least the level holds that fraction of the
+        posterior. With unequal bins the levels are of the pdf divided by
+        the relative bin sizes, see binning.density.
         """
 
-        return [brentq(lambda l:  self.pdf[self.pdf > l].sum() - p, 0.0, 1.0) for p in probs]
+        return credible_levels(binning.density(self.pdf, self.ybin_edges, self.xbin_edges),
+                               probs, self.pdf)
+
+
+class Matrix:
+    """ Calculate the one and two dimensional marginalised posteriors of every
+    variable and every pair of variables in a single pass over the data.
+
+    Each chunk of each column is read once, however many histograms it
+    contributes to. The results are ordinary oneD and twoD objects, found
+    in the oneD and twoD dictionaries or by indexing, e.g. M[x, x] for the
+    oneD of x and M[x, y] for the twoD of x and y where x precedes y in vars.
+
+    limits and bins are either the same for all variables, or dictionaries
+    keyed by variable. Variables missing from the dictionaries get defaults.
+    where selects the rows to use, see util.select. Chosen bins are limited
+    so that every twoD grid fits in budget bytes, see util.scan.
+    """
+
+    @profiling.operation
+    def __init__(self, h5file, vars, limits=None, bins=None, post_col='mult', where=None,
+                 budget=None):
+
+        self.h5file = h5file
+        self.vars = list(vars)
+        self.post_col = post_col
+        self.where = where
+
+        limits = limits if isinstance(limits, dict) else dict.fromkeys(self.vars, limits)
+        bins = bins if isinstance(bins, dict) else dict.fromkeys(self.vars, bins)
+
+        threenums = util.threenums(h5file, [v for v in self.vars if limits.get(v) is None],
+                                   post_col, where=where)
+
+        # the twoD grids are binned like the oneD grids, every pair has to fit
+        limits = {v: threenums[v][:2] if limits.get(v) is None else limits[v]
+                  for v in self.vars}
+        edges = util.binedges(h5file, self.vars, [limits[v] for v in self.vars],
+                              [bins.get(v) for v in self.vars], post_col, where, 8, budget,
+                              min(len(self.vars), 2))
+        bins = dict(zip(self.vars, edges))
+
+        self.oneD = {}
+        for x in self.vars:
+            P = oneD.__new__(oneD)
+            P._setup(h5file, x, limits.get(x), bins.get(x), post_col, threenums.get(x),
+                     where, budget)
+            self.oneD[x] = P
+
+        self.twoD = {}
+        for i, x in enumerate(self.vars):
+            for y in self.vars[i+1:]:
+                P = twoD.__new__(twoD)
+                P._setup(h5file, x, y, limits.get(x), limits.get(y),
+                         bins.get(x), bins.get(y), post_col,
+                         threenums.get(x), threenums.get(y), where, budget)
+                self.twoD[(x, y)] = P
+
+        names = self.vars + [self.post_col]
+
+        h5 = session.h5open(h5file, 'r')
+        for rows, cols in util.select(h5, names, where):
+            d = dict(zip(names, cols))
+            w = d[self.post_col]
+
+            # bin each variable once, the 2D bins are combinations of the 1D bins
+            index = {}
+            for x, P in self.oneD.items():
+                index[x] = binning.index(d[x], P.bin_edges)
+                P._add(index[x], w)
+
+            for (x, y), P in self.twoD.items():
+                P._add(binning.ravel(index[x], index[y], P.ynbins), w)
+        h5.close()
+
+        for P in self.twoD.values():
+            P._finalise()
+
+
+    def __getitem__(self, key):
+        x, y = key
+        return self.oneD[x] if x == y else self.twoD[(x, y)]
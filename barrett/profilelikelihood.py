@@ -2,46 +2,95 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import scipy.stats as stats
-import h5py
 import barrett.util as util
+import barrett.profiling as profiling
+import barrett.session as session
+import barrett.binning as binning
 
 
 class oneD:
     """ Calculate and plot the one dimensional profile likelihood.
+
+    workers, cache, where, bins and budget are those of every grid, see
+    util.scan.
     """
-    def __init__(self, h5file, var, limits=None, bins=None, lnl_col='-2lnL'):
+
+    _cached = ('chisq', 'bestfit_index')
+
+
+    @profiling.operation
+    def __init__(self, h5file, var, limits=None, bins=None, lnl_col='-2lnL',
+                 workers=None, cache=None, where=None, budget=None):
+
+        cache, restored = util.restore(self, cache, h5file=h5file, var=var, limits=limits,
+                                       bins=bins, lnl_col=lnl_col, where=where,
+                                       budget=budget)
+        if not restored:
+            self._setup(h5file, var, limits, bins, lnl_col,
+                        None if limits is not None else
+                        util.threenum(h5file, var, where=where), where, budget)
+            util.scan(self, workers, cache)
+
+        self._finalise()
+
+
+    def _setup(self, h5file, var, limits, bins, lnl_col, threenum, where=None, budget=None):
 
         self.h5file = h5file
         self.var = var
+        self.lnl_col = lnl_col
+        self.where = where
 
-        h5 = h5py.File(h5file, 'r')
+        h5 = session.h5open(h5file, 'r')
 
-        self.n = h5[self.var].shape[0]
-        self.name = h5[self.var].name
-        self.chunksize = h5[self.var].chunks[0]
+        self.n = util.column(h5, self.var).shape[0]
+        self.name = util.column(h5, self.var).name
+        self.chunksize = util.readsize(util.column(h5, self.var))
+
+        h5.close()
 
-        self.min, self.max, self.mean = util.threenum(self.h5file, self.var)
-        self.bins = np.floor(self.n**0.5) if bins is None else bins
-        self.nbins = self.bins if np.isscalar(self.bins) else self.bins[0]
+        # only calculated without limits
+        self.min, self.max, self.mean = threenum or (None, None, None)
         self.limits = (self.min, self.max) if limits is None else limits
 
-        chisq = np.zeros(self.nbins) + 1e100
-        s = self.chunksize
-        for i in range(0, self.n, s):
-            r = stats.binned_statistic(h5[self.var][i:i+s],
-                                       h5[lnl_col][i:i+s],
-                                       np.nanmin,
-                                       bins=self.bins,
-                                       range=self.limits)
-            chisq = np.fmin(chisq, r.statistic)
+        # chisq and bestfit_index, unweighted
+        self.bin_edges, = util.binedges(h5file, [var], [self.limits], [bins], None, where,
+                                        16, budget)
+        self.nbins = self.bin_edges.shape[0] - 1
+        self.bins = self.nbins if bins is None else bins
 
-        self.proflike = np.exp(-(chisq - chisq.min())/2.0)
+        self.chisq = np.zeros(self.nbins) + 1e100
+        self.bestfit_index = np.full(self.nbins, -1, dtype=np.int64)
 
-        self.bin_edges  = r.bin_edges
 
+    def _scan(self, start, stop):
+        h5 = session.h5open(self.h5file, 'r')
+        ranges = {self.var: (self.bin_edges[0], self.bin_edges[-1])}
+        for rows, (x, chi2) in util.select(h5, [self.var, self.lnl_col], self.where, start, stop,
+                                           ranges):
+            self._fill(rows, x, chi2)
         h5.close()
 
 
+    def _fill(self, rows, x, chi2):
+        self._add(rows, binning.index(x, self.bin_edges), chi2)
+
+
+    def _add(self, rows, i, chi2):
+        binning.lower(self.chisq, self.bestfit_index, i, chi2, rows)
+
+
+    def _merge(self, other):
+        better = other.chisq < self.chisq
+        self.chisq[better] = other.chisq[better]
+        self.bestfit_index[better] = other.bestfit_index[better]
+
+
+    def _finalise(self):
+        self.proflike = np.exp(-(self.chisq - self.chisq.min())/2.0)
+
+
+    @profiling.operation
     def plot(self, ax, **hist_kwargs):
 
         defaults = {
@@ -62,52 +111,106 @@ class oneD:
 
 class twoD:
     """ Calculate and plot the two dimensional profile likelihood.
+
+    workers, cache, where, bins and budget are those of every grid, see
+    util.scan.
     """
 
-    def __init__(self, h5file, xvar, yvar, xlimits=None, ylimits=None, xbins=None, ybins=None, lnl_col='-2lnL'):
+    _cached = ('chisq', 'bestfit_index')
+
+
+
+    @profiling.operation
+    def __init__(self, h5file, xvar, yvar, xlimits=None, ylimits=None, xbins=None, ybins=None, lnl_col='-2lnL',
+                 workers=None, cache=None, where=None, budget=None):
+
+        cache, restored = util.restore(self, cache, h5file=h5file, xvar=xvar, yvar=yvar,
+                                       xlimits=xlimits, ylimits=ylimits, xbins=xbins,
+                                       ybins=ybins, lnl_col=lnl_col, where=where,
+                                       budget=budget)
+        if not restored:
+            t = util.threenums(h5file, [v for v, l in ((xvar, xlimits), (yvar, ylimits))
+                                 if l is None], where=where)
+            self._setup(h5file, xvar, yvar, xlimits, ylimits, xbins, ybins, lnl_col,
+                        t.get(xvar), t.get(yvar), where, budget)
+            util.scan(self, workers, cache)
+
+        self._finalise()
+
+
+    def _setup(self, h5file, xvar, yvar, xlimits, ylimits, xbins, ybins, lnl_col,
+               xthreenum, ythreenum, where=None, budget=None):
 
         self.h5file = h5file
         self.xvar = xvar
         self.yvar = yvar
+        self.lnl_col = lnl_col
+        self.where = where
+
+        h5 = session.h5open(h5file, 'r')
 
-        h5 = h5py.File(h5file, 'r')
+        self.n = util.column(h5, self.xvar).shape[0]
+        self.chunksize = util.readsize(util.column(h5, self.xvar))
+        self.xname = util.column(h5, self.xvar).name
+        self.yname = util.column(h5, self.yvar).name
 
-        self.n = h5[self.xvar].shape[0]
-        self.chunksize = h5[self.xvar].chunks[0]
-        self.xname = h5[self.xvar].name
-        self.yname = h5[self.yvar].name
+        h5.close()
 
-        self.xmin, self.xmax, self.xmean = util.threenum(self.h5file, self.xvar)
-        self.ymin, self.ymax, self.ymean = util.threenum(self.h5file, self.yvar)
+        # only calculated without limits
+        self.xmin, self.xmax, self.xmean = xthreenum or (None, None, None)
+        self.ymin, self.ymax, self.ymean = ythreenum or (None, None, None)
 
-        self.xbins = np.floor(self.n**0.5) if xbins is None else xbins
-        self.ybins = np.floor(self.n**0.5) if ybins is None else ybins
-        self.xnbins = self.xbins if np.isscalar(self.xbins) else self.xbins.shape[0] -1
-        self.ynbins = self.ybins if np.isscalar(self.ybins) else self.ybins.shape[0] -1
         self.xlimits = (self.xmin, self.xmax) if xlimits is None else xlimits
         self.ylimits = (self.ymin, self.ymax) if ylimits is None else ylimits
 
-        chisq = np.zeros((self.xnbins, self.ynbins)) + 1e100
-        s = self.chunksize
-        for i in range(0, self.n, s):
-            r = stats.binned_statistic_2d(h5[self.xvar][i:i+s],
-                                          h5[self.yvar][i:i+s],
-                                          h5[lnl_col][i:i+s],
-                                          np.nanmin,
-                                          bins=[self.xbins, self.ybins],
-                                          range=[self.xlimits, self.ylimits])
-            chisq = np.fmin(chisq, r.statistic)
-        chisq = chisq.T
-        self.proflike = np.exp(-(chisq - chisq.min())/2.0)
-
-        self.xbin_edges  = r.x_edge
-        self.ybin_edges  = r.y_edge
+        # chisq and bestfit_index, unweighted
+        self.xbin_edges, self.ybin_edges = util.binedges(h5file, [xvar, yvar],
+                                                         [self.xlimits, self.ylimits],
+                                                         [xbins, ybins], None, where,
+                                                         16, budget)
+        self.xnbins = self.xbin_edges.shape[0] - 1
+        self.ynbins = self.ybin_edges.shape[0] - 1
+        self.xbins = self.xnbins if xbins is None else xbins
+        self.ybins = self.ynbins if ybins is None else ybins
+
+        self.chisq = np.zeros((self.xnbins, self.ynbins)) + 1e100
+        self.bestfit_index = np.full((self.xnbins, self.ynbins), -1, dtype=np.int64)
+
+
+    def _scan(self, start, stop):
+        h5 = session.h5open(self.h5file, 'r')
+        ranges = {self.xvar: (self.xbin_edges[0], self.xbin_edges[-1]),
+                  self.yvar: (self.ybin_edges[0], self.ybin_edges[-1])}
+        for rows, (x, y, chi2) in util.select(h5, [self.xvar, self.yvar, self.lnl_col], self.where,
+                                              start, stop, ranges):
+            self._fill(rows, x, y, chi2)
+        h5.close()
+
+
+    def _fill(self, rows, x, y, chi2):
+        self._add(rows, binning.index2d(x, y, self.xbin_edges, self.ybin_edges), chi2)
+
+
+    def _add(self, rows, i, chi2):
+        binning.lower(self.chisq, self.bestfit_index, i, chi2, rows)
+
+
+    def _merge(self, other):
+        better = other.chisq < self.chisq
+        self.chisq[better] = other.chisq[better]
+        self.bestfit_index[better] = other.bestfit_index[better]
+
+
+    def _finalise(self):
+        self.chisq = self.chisq.T
+        self.bestfit_index = self.bestfit_index.T
+        self.proflike = np.exp(-(self.chisq - self.chisq.min())/2.0)
+
         self.xcenters = self.xbin_edges[:-1] + np.diff(self.xbin_edges)/2.0
         self.ycenters = self.ybin_edges[:-1] + np.diff(self.ybin_edges)/2.0
 
-        h5.close()
-
 
+    @profiling.operation
     def plot(self, ax, levels=[0.95, 0.68], cmap=None, **contourf_kwargs):
 
         X, Y = np.meshgrid(self.xcenters, self.ycenters)
@@ -0,0 +1,170 @@
+import time
+import json
+import functools
+import threading
+import contextlib
+
+# The Profile recording, None when not profiling.
+_active = None
+
+
+class Profile:
+    """ What barrett spent its time on while profiling, see profile.
+
+    Every profiled operation, e.g. posterior.twoD or data.Chain.derive, is
+    timed, and so is every chunk it goes through. For each chunk the time
+    to read it, which includes decompressing it, the bytes read, and the
+    time spent computing on it before the next chunk is asked for are
+    recorded. Chunks that are skipped without being read, see util.select,
+    are counted. Work done in worker processes is not recorded.
+    """
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.events = []
+        self.stats = {}
+        self.stack = []
+        self.lock = threading.Lock()
+
+
+    def _stats(self):
+        name = self.stack[-1] if self.stack else '(none)'
+        if name not in self.stats:
+            self.stats[name] = dict.fromkeys(('calls', 'seconds', 'read', 'bytes', 'compute',
+                                              'chunks', 'skipped'), 0)
+        return self.stats[name]
+
+
+    def _event(self, name, cat, start, duration, **args):
+        self.events.append({'name': name, 'cat': cat, 'ph': 'X',
+                            'ts': (start - self.t0)*1e6, 'dur': duration*1e6,
+                            'pid': 0, 'tid': threading.get_ident(), 'args': args})
+
+
+    def read(self, start, duration, nbytes):
+        with self.lock:
+            s = self._stats()
+            s['read'] += duration
+            s['bytes'] += nbytes
+            self._event('read', 'io', start, duration, bytes=nbytes)
+
+
+    def compute(self, start, duration):
+        with self.lock:
+            s = self._stats()
+            s['compute'] += duration
+            s['chunks'] += 1
+            self._event('compute', 'compute', start, duration)
+
+
+    def skip(self, n):
+        with self.lock:
+            self._stats()['skipped'] += n
+
+
+    def summary(self):
+        """A table of the calls, total time, read time, MB read, read speed,
+        compute time, and chunks processed and skipped of every operation.
+        """
+        lines = ['%-36s %6s %9s %9s %9s %8s %9s %8s %8s'
+                 % ('operation', 'calls', 'total s', 'read s', 'MB read', 'MB/s',
+                    'compute s', 'chunks', 'skipped')]
+        for name, s in sorted(self.stats.items(), key=lambda i: -i[1]['seconds']):
+            mb = s['bytes']/2.0**20
+            lines.append('%-36s %6d %9.3f %9.3f %9.1f %8.1f %9.3f %8d %8d'
+                         % (name[-36:], s['calls'], s['seconds'], s['read'], mb,
+                            mb/s['read'] if s['read'] > 0 else 0.0, s['compute'],
+                            s['chunks'], s['skipped']))
+        return '\n'.join(lines)
+
+
+    def trace(self, path):
+        """Write the events as a Chrome trace, for chrome://tracing or Perfetto."""
+        f = open(path, 'w')
+        json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        f.close()
+
+
+@contextlib.contextmanager
+def profile():
+    """ Profile everything barrett does in the with block,
+
+      with barrett.profile() as p:
+          barrett.posterior.twoD('chain.h5', 'x', 'y')
+      print(p.summary())
+      p.trace('trace.json')
+
+    Yields the Profile. Outside profile barrett does no bookkeeping.
+    """
+    global _active
+
+    previous = _active
+    _active = Profile()
+    try:
+        yield _active
+    finally:
+        _active = previous
+
+
+def operation(func):
+    """Decorator timing every call of func as an operation while profiling."""
+    name = func.__module__ + '.' + func.__qualname__.replace('.__init__', '')
+
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        p = _active
+        if p is None:
+            return func(*args, **kwargs)
+
+        with p.lock:
+            p.stack.append(name)
+            p._stats()['calls'] += 1
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            with p.lock:
+                p._stats()['seconds'] += duration
+                p._event(name, 'operation', start, duration)
+                p.stack.pop()
+
+    return timed
+
+
+def reader(read):
+    """The chunk reader read of util, timed while profiling."""
+    p = _active
+    if p is None:
+        return read
+
+    def timed(i, e, *args):
+        start = time.perf_counter()
+        values = read(i, e, *args)
+        p.read(start, time.perf_counter() - start, sum(v.nbytes for v in values))
+        return values
+
+    return timed
+
+
+def loop(chunks):
+    """The iterator over chunks chunks, timing what is done with each chunk
+    while profiling.
+    """
+    p = _active
+    if p is None:
+        return chunks
+    return _timed(p, chunks)
+
+
+def _timed(p, chunks):
+    for c in chunks:
+        start = time.perf_counter()
+        yield c
+        p.compute(start, time.perf_counter() - start)
+
+
+def skip(n=1):
+    """Count n chunks skipped without being read."""
+    if _active is not None:
+        _active.skip(n)
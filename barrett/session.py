@@ -0,0 +1,133 @@
+import os
+import h5py
+
+# Default size in bytes of the chunk cache of every column, see Session.
+RDCC_NBYTES = 16 * 2**20
+
+# Default number of slots of the chunk caches, a prime well above the
+# number of chunks that fit.
+RDCC_NSLOTS = 10007
+
+
+class Session:
+    """ A chain file kept open across calls, together with the caches of
+    its decompressed chunks.
+
+    A Session is accepted wherever a path to a chain file is, e.g.
+
+      with barrett.open_chain('chain.h5') as chain:
+          for x, y in pairs:
+              barrett.posterior.twoD(chain, x, y)
+
+    and every call uses the open file instead of opening it again. Each
+    column keeps a chunk cache of rdcc_nbytes bytes with rdcc_nslots slots,
+    so the chunks a plot reads are not read and decompressed again by the
+    next plot as long as they fit. The columns stay open, and so keep their
+    cache, until the session is closed.
+
+    mode is that of h5py.File. Operations that write to the file, e.g.
+    those of data.Chain, need 'r+' or 'a'; on a read-only session they
+    raise OSError, and the statistics that would be cached are not. Worker
+    processes open the file read-only themselves, with the same cache.
+    """
+
+    def __init__(self, path, mode='r', rdcc_nbytes=RDCC_NBYTES, rdcc_nslots=RDCC_NSLOTS):
+        self.path = os.fspath(path)
+        self.mode = mode
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+
+        self.file = None
+        self.columns = {}
+        self._open()
+
+
+    def _open(self):
+        self.file = h5py.File(self.path, self.mode, rdcc_nbytes=self.rdcc_nbytes,
+                              rdcc_nslots=self.rdcc_nslots)
+        self.columns = {}
+        self._hold()
+
+
+    def _hold(self):
+        """Keep every dataset of the file open, HDF5 drops the chunk cache of
+        a dataset once nothing has it open.
+        """
+        for k, d in self.file.items():
+            if isinstance(d, h5py.Dataset) and self.columns.get(k) != d:
+                self.columns[k] = d
+
+
+    def handle(self, mode='r'):
+        """The open file, as an h5py.File that close leaves open."""
+        if self.file is None:
+            self._open()
+
+        if mode != 'r' and self.file.mode == 'r':
+            raise OSError('%s is open read-only.' % self.path)
+        if mode == 'w':
+            raise OSError('%s is open, it cannot be truncated.' % self.path)
+
+        if self.file.mode != 'r':
+            # columns may have been added or replaced since
+            self._hold()
+
+        return _Shared(self.file.id)
+
+
+    def close(self):
+        if self.file is not None:
+            self.columns = {}
+            self.file.close()
+            self.file = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def __fspath__(self):
+        return self.path
+
+
+    def __repr__(self):
+        return '<barrett Session %r (%s)>' % (self.path, 'closed' if self.file is None
+                                                 else self.mode)
+
+
+    def __getstate__(self):
+        # for worker processes, which only read and open the file themselves
+        return {'path': self.path, 'mode': 'r',
+                'rdcc_nbytes': self.rdcc_nbytes, 'rdcc_nslots': self.rdcc_nslots}
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.file = None
+        self.columns = {}
+
+
+class _Shared(h5py.File):
+    """The file of a Session, which close only flushes."""
+
+    def close(self):
+        if self.id.valid and self.mode != 'r':
+            self.flush()
+
+
+def open_chain(path, mode='r', rdcc_nbytes=RDCC_NBYTES, rdcc_nslots=RDCC_NSLOTS):
+    """Open the chain file path as a Session, see Session."""
+    return Session(path, mode, rdcc_nbytes, rdcc_nslots)
+
+
+def h5open(h5file, mode='r'):
+    """The h5py.File of h5file, a path or a Session. The file of a Session
+    is shared, closing it leaves it open.
+    """
+    if isinstance(h5file, Session):
+        return h5file.handle(mode)
+    return h5py.File(h5file, mode)
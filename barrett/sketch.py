@@ -0,0 +1,95 @@
+import numpy as np
+
+
+class TDigest:
+    """Weighted quantile sketch, a merging t-digest.
+
+    The data is summarised by at most about delta/2 centroids, (mean, weight)
+    pairs, which are small near the tails and large near the median. So
+    quantiles are estimated in a single pass and bounded memory, with the
+    best relative accuracy in the tails where credible intervals are read
+    off. Digests of different parts of the data merge into the digest of
+    the whole, whichever process calculated them.
+    """
+
+    def __init__(self, delta=1000):
+        self.delta = delta
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.min = np.inf
+        self.max = -np.inf
+        self.total = 0.0
+
+
+    def add(self, x, w):
+        """Add the values x with weights w, ignoring non-finite values and
+        non-positive weights.
+        """
+        keep = np.isfinite(x) & (w > 0)
+        x = x[keep]
+        w = w[keep]
+
+        if x.shape[0] == 0:
+            return
+
+        self.min = min(self.min, x.min())
+        self.max = max(self.max, x.max())
+        self.total += np.sum(w*x)
+
+        self._compress(np.concatenate((self.means, x)),
+                       np.concatenate((self.weights, w)))
+
+
+    def merge(self, other):
+        """Add the data summarised by the digest other."""
+        if other.weights.shape[0] == 0:
+            return
+
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.total += other.total
+
+        self._compress(np.concatenate((self.means, other.means)),
+                       np.concatenate((self.weights, other.weights)))
+
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+
+        # Centroids starting within the same unit of the scale function
+        # k(q) = delta/(2 pi) arcsin(2q - 1) are merged.
+        cum = np.cumsum(weights)
+        q = (cum - weights)/cum[-1]
+        k = np.floor(self.delta/(2*np.pi)*np.arcsin(2*q - 1))
+        start = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+
+        self.weights = np.add.reduceat(weights, start)
+        self.means = np.add.reduceat(weights*means, start)/self.weights
+
+
+    @property
+    def wsum(self):
+        return self.weights.sum()
+
+
+    @property
+    def mean(self):
+        return self.total/self.wsum
+
+
+    def quantile(self, q):
+        """The weighted quantiles q, NaN if the digest is empty."""
+        q = np.asarray(q, dtype=np.float64)
+
+        if self.weights.shape[0] == 0:
+            return np.full(q.shape, np.nan)
+
+        # Each centroid sits at the middle of its weight, the extremes at
+        # the ends.
+        cum = np.cumsum(self.weights)
+        centers = np.concatenate(([0.0], cum - self.weights/2.0, [cum[-1]]))
+        values = np.concatenate(([self.min], self.means, [self.max]))
+
+        return np.interp(q*cum[-1], centers, values)
@@ -2,63 +2,1425 @@ import h5py
 import numpy as np
 import scipy as sp
 import itertools
+import functools
+import os
+import re
+import json
+import ast
+import time
+import uuid
+import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import barrett.sketch as sketch
+import barrett.binning as binning
+import barrett.profiling as profiling
+import barrett.session as session
+import barrett.cache
 
-def threenum(h5file, var, post_col='mult'):
+try:
+    # registers the blosc, zstd and lz4 filters with HDF5
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+STATS = ('min', 'max', 'mean', 'nonfinite', 'wsum')
+
+# Name of the optional (n, ncols) dataset holding several columns row by row.
+BLOCK = 'barrett.block'
+
+# File attribute with the expressions of the virtual columns, as JSON.
+VIRTUAL = 'barrett.virtual'
+
+# Group of the zone maps, the per-chunk min, max and weight sum of columns.
+ZONES = 'barrett.zones'
+
+# Columns of a zone map, the last three are 1 if the chunk has such values.
+ZONE = ('min', 'max', 'wsum', '-inf', '+inf', 'nan')
+
+# Rows read at a time from columns that are not chunked, see MappedColumn.
+WINDOW = 1 << 20
+
+# Chunks read ahead in the background by chunks and select, 0 for none.
+PREFETCH = 2
+
+
+class BlockColumn:
+    """A column of the block dataset, with the parts of the h5py Dataset
+    interface barrett uses: shape, chunks, name, attrs and slicing.
+    """
+
+    def __init__(self, block, name):
+        self.block = block
+        self.index = list(block.attrs['barrett.columns']).index(name)
+        self.name = '/' + name
+        self.shape = block.shape[:1]
+        self.chunks = block.chunks[:1] if block.chunks else None
+        self.attrs = _PrefixAttrs(block.attrs, name + ':')
+
+
+    def __getitem__(self, key):
+        return self.block[key, self.index]
+
+
+    def __setitem__(self, key, value):
+        self.block[key, self.index] = value
+
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+class MappedColumn:
+    """An uncompressed, contiguous dataset, stored in the HDF5 file or in an
+    external .npy file (see contiguous), read through a read-only np.memmap
+    of its data. Slices are views of the mapped file, without read calls.
+    Has the same interface as BlockColumn.
+    """
+
+    def __init__(self, d, path, offset):
+        self.dataset = d
+        self.id = d.id
+        self.name = d.name
+        self.shape = d.shape
+        self.dtype = d.dtype
+        self.chunks = None
+        self.attrs = d.attrs
+        self.path = path
+        self.offset = offset
+        self.map = np.memmap(path, dtype=d.dtype, mode='r', offset=offset, shape=d.shape)
+
+
+    def __getitem__(self, key):
+        return self.map[key]
+
+
+    def __setitem__(self, key, value):
+        if self.path == self.dataset.file.filename:
+            self.dataset[key] = value
+        else:
+            m = np.memmap(self.path, dtype=self.dtype, mode='r+', offset=self.offset,
+                          shape=self.shape)
+            m[key] = value
+            m.flush()
+
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.map, dtype=dtype)
+
+
+class VirtualColumn:
+    """A column calculated from an expression of other columns whenever it is
+    read, see data.Chain.virtual. Has the same interface as BlockColumn,
+    but is read-only.
+    """
+
+    def __init__(self, h5, name, expr):
+        self.h5 = h5
+        self.expr = expr
+        self.code, self.args = expression(expr, [k for k in names(h5) if k != name])
+        if not self.args:
+            raise ValueError('Virtual column %s depends on no other columns.' % name)
+
+        first = column(h5, self.args[0])
+        self.name = '/' + name
+        self.shape = first.shape
+        self.chunks = first.chunks
+        self.attrs = _PrefixAttrs(h5.attrs, name + ':')
+
+
+    def __getitem__(self, key):
+        return self.evaluate([column(self.h5, a)[key] for a in self.args])
+
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+    def evaluate(self, values):
+        """The column from the values of the columns in self.args."""
+        return evaluate(self.code, values)
+
+
+class _PrefixAttrs:
+    """The attributes of a block or virtual column, kept in the attributes of
+    the block or the file as 'name:key'.
+    """
+
+    def __init__(self, attrs, prefix):
+        self.attrs = attrs
+        self.prefix = prefix
+
+
+    def __contains__(self, key):
+        return self.prefix + key in self.attrs
+
+
+    def __getitem__(self, key):
+        return self.attrs[self.prefix + key]
+
+
+    def __setitem__(self, key, value):
+        self.attrs[self.prefix + key] = value
+
+
+    def __delitem__(self, key):
+        del self.attrs[self.prefix + key]
+
+
+    def get(self, key, default=None):
+        return self.attrs.get(self.prefix + key, default)
+
+
+def names(h5):
+    """Names of all columns in the file, whatever their layout, virtual
+    columns last.
+    """
+    cols = _stored(h5)
+    cols += [k for k in virtual(h5) if k not in cols]
+    return cols
+
+
+def _stored(h5):
+    cols = [k for k in h5.keys() if k not in (BLOCK, ZONES)]
+    if BLOCK in h5:
+        cols += [k for k in h5[BLOCK].attrs['barrett.columns'] if k not in cols]
+    return cols
+
+
+def virtual(h5):
+    """Dictionary of the expressions of the virtual columns in the file."""
+    return json.loads(h5.attrs.get(VIRTUAL, '{}'))
+
+
+def column(h5, name):
+    """The named column, from the block dataset if it holds it, calculated
+    if it is virtual, memory-mapped if it is contiguous.
+    """
+    if BLOCK in h5 and name in h5[BLOCK].attrs['barrett.columns']:
+        return BlockColumn(mapped(h5[BLOCK]), name)
+    if name in h5:
+        return mapped(h5[name])
+
+    v = virtual(h5)
+    if name in v:
+        dependencies(h5, v, name)
+        return VirtualColumn(h5, name, v[name])
+
+    raise KeyError('No column %s in %s.' % (name, h5.filename))
+
+
+def dependencies(h5, exprs, name):
+    """The columns the virtual column name depends on, directly or through
+    other virtual columns, where exprs are the expressions of the virtual
+    columns, see virtual. Raises ValueError if it depends on itself.
+    """
+    stored = _stored(h5)
+    cols = set(stored) | set(exprs)
+
+    found = []
+    def visit(k, path):
+        for a in expression(exprs[k], cols - {k})[1]:
+            if a in path:
+                raise ValueError('Virtual column %s depends on itself, %s.'
+                                 % (a, ' -> '.join(path + [a])))
+            if a not in found:
+                found.append(a)
+            if a in exprs and a not in stored:
+                visit(a, path + [a])
+
+    visit(name, [name])
+    return found
+
+
+def copies(h5, name):
+    """Every stored copy of the named column."""
+    copies = [mapped(h5[name])] if name in h5 and name not in (BLOCK, ZONES) else []
+    if BLOCK in h5 and name in h5[BLOCK].attrs['barrett.columns']:
+        copies.append(BlockColumn(mapped(h5[BLOCK]), name))
+    return copies
+
+
+def mapped(d):
+    """The dataset d as a MappedColumn if its data is uncompressed and in one
+    piece, in the file or an external file, otherwise d.
+    """
+    if d.chunks is not None or d.size == 0:
+        return d
+
+    dcpl = d.id.get_create_plist()
+    if dcpl.get_external_count() == 1:
+        name, offset, size = dcpl.get_external(0)
+        # relative to the HDF5 file, not the working directory
+        path = os.path.join(os.path.dirname(os.path.abspath(d.file.filename)),
+                            name.decode())
+    elif dcpl.get_external_count() == 0:
+        path = d.file.filename
+        offset = d.id.get_offset()
+        if offset is None:
+            return d
+    else:
+        return d
+
+    return MappedColumn(d, path, offset)
+
+
+def readsize(c):
+    """Rows read at a time from the column c, a chunk or, if c is not
+    chunked, WINDOW rows.
+    """
+    return c.chunks[0] if c.chunks is not None else WINDOW
+
+
+def threenum(h5file, var, post_col='mult', cache=True, where=None):
     """ Calculates the three number summary for a variable.
 
     The three number summary is the minimum, maximum and the mean
     of the data. Traditionally one would summerise data with the
     five number summary: max, min, 1st, 2nd (median), 3rd quartile.
     But quantiles are hard to calculate without sorting the data
-    which hard to do out-of-core.
+    which hard to do out-of-core, see fivenum for estimates.
+
+    The summary comes from colstats, so it is only calculated once per
+    column as long as the file is writable. where selects rows, see select.
     """
-    f = h5py.File(h5file, 'r')
-    d = f[var]
-    w = f[post_col]
-    s = d.chunks[0]
+    s = colstats(h5file, var, post_col, cache, where)
+    return (s['min'], s['max'], s['mean'])
 
-    n = d.shape[0]
-    maxval = -np.abs(d[0])
-    minval = np.abs(d[0])
-    total = 0
-    wsum = 0
 
-    for x in range(0, n, s):
+def threenums(h5file, vars, post_col='mult', cache=True, where=None):
+    """The three number summaries of several variables, see threenum, as a
+    dictionary keyed by variable. Those not cached are calculated together
+    in a single pass over the data, see stats.
+    """
+    return {v: (s['min'], s['max'], s['mean'])
+            for v, s in stats(h5file, vars, post_col, cache, where).items()}
 
-        aN = ~np.logical_or(np.isnan(d[x:x+s]), np.isinf(d[x:x+s]))
 
-        d_c = d[x:x+s][aN]
-        w_c = w[x:x+s][aN]
+def fivenum(h5file, var, post_col='mult', where=None):
+    """ Calculates the five number summary for a variable: minimum,
+    1st quartile, median, 3rd quartile and maximum.
 
-        chunk_max = np.max(d_c)
-        chunk_min = np.min(d_c)
+    The quartiles are estimates, see summary.
+    """
+    s = summary(h5file, [var], (0.25, 0.5, 0.75), post_col, where=where)[var]
+    return (s['min'],) + tuple(s['quantiles']) + (s['max'],)
 
-        maxval = chunk_max if chunk_max > maxval else maxval
-        minval = chunk_min if chunk_min < minval else minval
 
-        total += np.sum(w_c*d_c)
-        wsum  += np.sum(w_c)
+@profiling.operation
+def summary(h5file, vars, quantiles=(0.025, 0.16, 0.5, 0.84, 0.975), post_col='mult',
+            delta=1000, workers=None, where=None):
+    """ Weighted quantiles, min, max and mean of several variables in a
+    single pass over the data.
+
+    The default quantiles are the median and the bounds of the central 68%
+    and 95% credible intervals. They are estimated by a sketch.TDigest per
+    variable, in memory independent of the number of rows, more accurately
+    the larger delta. With workers the rows are split over that many
+    processes and their digests merged. where selects rows, see select.
+
+    Returns a dictionary keyed by variable of dictionaries with the keys
+    min, max, mean, wsum and quantiles. Non-finite values are ignored.
+    """
+    vars = list(vars)
+
+    if workers is None or workers <= 1:
+        digests = _digest((h5file, vars, post_col, delta, where, 0, None))
+    else:
+        f = session.h5open(h5file, 'r')
+        d = column(f, vars[0])
+        tasks = [(h5file, vars, post_col, delta, where, start, stop)
+                 for start, stop in slices(d.shape[0], readsize(d), workers)]
+        f.close()
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            parts = pool.map(_digest, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        digests = parts[0]
+        for part in parts[1:]:
+            for v in vars:
+                digests[v].merge(part[v])
+
+    return {v: {'min': D.min,
+                'max': D.max,
+                'mean': D.mean,
+                'wsum': D.wsum,
+                'quantiles': D.quantile(quantiles)}
+            for v, D in digests.items()}
+
+
+def _digest(args):
+    """The digests of the variables in the rows [start, stop)."""
+    h5file, vars, post_col, delta, where, start, stop = args
+
+    digests = {v: sketch.TDigest(delta) for v in vars}
+
+    f = session.h5open(h5file, 'r')
+    for rows, cols in select(f, vars + [post_col], where, start, stop):
+        w = cols[-1]
+        for v, x in zip(vars, cols):
+            digests[v].add(x, w)
+    f.close()
+
+    return digests
+
+
+def binedges(h5file, vars, limits, bins, post_col=None, where=None, itemsize=8,
+             budget=None, ndim=None):
+    """ The bin edges of a grid along the variables vars, over their limits.
+
+    bins has the bins of each variable: a number, an array of edges, None
+    for the square root of the number of rows, or one of binning.RULES,
+    chosen in one pass over the rows selected by where (see binsketch),
+    weighted by post_col. The chosen numbers of bins are scaled down so
+    that the grid, of items of itemsize bytes, fits in budget bytes (see
+    binning.cap). Given bins that do not fit are a ValueError. With ndim
+    every grid along ndim of the variables has to fit.
+    """
+    budget = binning.BUDGET if budget is None else budget
+    ndim = len(vars) if ndim is None else ndim
+
+    for v, l, b in zip(vars, limits, bins):
+        # the limits from threenum of a selection without finite values
+        if np.ndim(b) == 0 and not np.isfinite(np.asarray(l, dtype=np.float64)).all():
+            raise ValueError('No finite values of %s in the selected rows, give its limits.' % v)
+
+    rules = [(v, l) for v, l, b in zip(vars, limits, bins) if isinstance(b, str)]
+    sketches = binsketch(h5file, [v for v, l in rules], [l for v, l in rules],
+                         post_col, where) if rules else {}
+
+    counts = []
+    for v, l, b in zip(vars, limits, bins):
+        if b is None:
+            f = session.h5open(h5file, 'r')
+            counts.append(int(np.floor(column(f, v).shape[0]**0.5)))
+            f.close()
+        elif isinstance(b, str):
+            counts.append(binning.count(b, sketches[v][2], sketches[v][0], sketches[v][1], l))
+        else:
+            counts.append(None)
+
+    given = sorted((np.size(b) - 1 if np.ndim(b) else int(b)
+                    for b, c in zip(bins, counts) if c is None), reverse=True)
+    size = itemsize*np.prod(given[:ndim], dtype=np.float64)
+    if size > budget:
+        raise ValueError('A grid of the given bins takes %.0f MB, more than the budget of %.0f MB.'
+                         % (size/2**20, budget/2**20))
+
+    chosen = [c for c in counts if c is not None]
+    if chosen:
+        if ndim == len(vars):
+            chosen = binning.cap(chosen, size, budget)
+        else:
+            m = binning.cap([max(chosen)]*ndim, itemsize, budget)[0]
+            chosen = [min(c, m) for c in chosen]
+    chosen = iter(chosen)
+
+    edges = []
+    for v, l, b, c in zip(vars, limits, bins, counts):
+        if c is None:
+            edges.append(binning.edges(b, l))
+        elif b == 'quantile':
+            edges.append(binning.quantiles(next(chosen), sketches[v][0], l))
+        else:
+            edges.append(binning.edges(next(chosen), l))
+    return edges
+
+
+@profiling.operation
+def binsketch(h5file, vars, limits, post_col=None, where=None, delta=1000, fine=1024):
+    """ What binning.count needs to choose the bins of the variables, in one
+    pass over the rows selected by where.
+
+    Returns a dictionary keyed by variable of the sketch.TDigest of the
+    values within limits weighted by post_col, unweighted without it, a
+    histogram of them in fine equal bins, and their effective number,
+    (sum w)^2/sum w^2.
+    """
+    vars = list(vars)
+    names = vars + ([post_col] if post_col is not None else [])
+
+    digests = {v: sketch.TDigest(delta) for v in vars}
+    hists = {v: np.zeros(fine) for v in vars}
+    sums = {v: np.zeros(2) for v in vars}
+
+    f = session.h5open(h5file, 'r')
+    for rows, cols in select(f, names, where):
+        w = cols[-1] if post_col is not None else np.ones(rows.shape[0])
+        for v, x, (lo, hi) in zip(vars, cols, limits):
+            keep = (x >= lo) & (x <= hi)
+            digests[v].add(x[keep], w[keep])
+            hists[v] += binning.sum(binning.index(x[keep], binning.edges(fine, (lo, hi))),
+                                    w[keep], fine)
+            sums[v] += (np.sum(w[keep]), np.sum(w[keep]**2))
     f.close()
 
-    mean = total/float(wsum)
+    return {v: (digests[v], hists[v], sums[v][0]**2/sums[v][1] if sums[v][1] > 0 else 0.0)
+            for v in vars}
+
+
+def colstats(h5file, var, post_col='mult', cache=True, where=None):
+    """ Statistics of a variable: min, max, weighted mean, the number of
+    non-finite values, and the sum of the weights.
+
+    The statistics are cached as attributes of the dataset. Cached values
+    are used if they were calculated with the same post_col, otherwise they
+    are calculated and, if cache is true and the file can be opened for
+    writing, stored for next time together with the zone map of the column
+    (see zones). data.Chain removes the cache of every column it writes.
+    Statistics of the rows selected by where, see select, are always
+    calculated.
+    """
+    return stats(h5file, [var], post_col, cache, where)[var]
+
+
+@profiling.operation
+def stats(h5file, vars, post_col='mult', cache=True, where=None):
+    """ The statistics of colstats of several variables, as a dictionary
+    keyed by variable. Those not cached are calculated together in a single
+    pass over the data.
+    """
+    vars = list(vars)
+
+    f = session.h5open(h5file, 'r')
+    result = {}
+    if where is None:
+        for v in vars:
+            s = cached_stats(column(f, v), post_col)
+            if s is not None:
+                result[v] = s
+
+    missing = [v for v in vars if v not in result]
+    if not missing:
+        f.close()
+        return result
+
+    new = _colstats(f, missing, post_col, where)
+    zs = {v: new[v].pop('zones', None) for v in missing}
+    sizes = {v: readsize(column(f, v)) for v in missing}
+    f.close()
+    result.update(new)
+
+    if cache and where is None:
+        try:
+            f = session.h5open(h5file, 'r+')
+        except OSError:
+            # read-only or opened by someone else, calculate again next time
+            return result
+        for v in missing:
+            store_stats(column(f, v), post_col, new[v])
+            store_zones(f, v, zs[v], sizes[v], post_col)
+        f.close()
+
+    return result
+
+
+def cached_stats(d, post_col):
+    """The statistics cached on the dataset d for post_col, None if missing."""
+    if d.attrs.get('barrett.post_col') != post_col:
+        return None
+    return {k: d.attrs['barrett.' + k] for k in STATS}
+
+
+def store_stats(d, post_col, s):
+    """Cache the statistics s, calculated with post_col, on the dataset d."""
+    d.attrs['barrett.post_col'] = post_col
+    for k in STATS:
+        d.attrs['barrett.' + k] = s[k]
+
+
+def stamp(h5, name):
+    """Give every copy of the named column a new random version. The version
+    identifies the data of the column in barrett.cache, and is renewed
+    whenever the data is written.
+    """
+    version = uuid.uuid4().hex
+    for d in copies(h5, name):
+        d.attrs['barrett.version'] = version
+
+
+def clear_stats(h5, name):
+    """Remove the cached statistics, best fit rows and zone maps of the named
+    dataset, and of every dataset whose statistics are weighted by it. Those
+    of the virtual columns are always removed, they may depend on it.
+    """
+    # the data of name has changed, see barrett.cache
+    stamp(h5, name)
+
+    attrs = [d.attrs for k in names(h5) for d in copies(h5, k)
+             if d.name.lstrip('/') == name or d.attrs.get('barrett.post_col') == name]
+    # without calculating the virtual columns, only their attributes are needed
+    attrs += [_PrefixAttrs(h5.attrs, k + ':') for k in virtual(h5)]
+
+    for a in attrs:
+        for k in ('post_col', 'bestfit') + STATS:
+            if 'barrett.' + k in a:
+                del a['barrett.' + k]
+
+    if ZONES in h5:
+        g = h5[ZONES]
+        for k in list(g.keys()):
+            if k == name or g[k].attrs['post_col'] == name or k in virtual(h5):
+                del g[k]
+
+
+def _colstats(h5, vars, post_col, where=None):
+    """The statistics of colstats of the variables vars, in one pass, as a
+    dictionary keyed by variable. Without where the zone map of each column
+    is included under the key zones, see zones.
+    """
+    names = vars + [post_col] if post_col not in vars else vars
+    p = names.index(post_col)
+
+    minval = dict.fromkeys(vars, np.inf)
+    maxval = dict.fromkeys(vars, -np.inf)
+    total = dict.fromkeys(vars, 0.0)
+    wsum = dict.fromkeys(vars, 0.0)
+    nonfinite = dict.fromkeys(vars, 0)
+    zs = {v: [] for v in vars}
+    keep = np.empty(0, dtype=bool)
+
+    for rows, cols in select(h5, names, where):
+        w = cols[p]
+        n = w.shape[0]
+        if keep.shape[0] < n:
+            keep = np.empty(n, dtype=bool)
+        k = keep[:n]
+
+        for v, d in zip(vars, cols):
+            np.isfinite(d, out=k)
+            bad = n - np.count_nonzero(k)
+
+            if bad == 0:
+                lo, hi, t, ws = d.min(), d.max(), np.dot(w, d), w.sum()
+                flags = (0, 0, 0)
+            else:
+                if bad < n:
+                    lo = np.min(d, where=k, initial=np.inf)
+                    hi = np.max(d, where=k, initial=-np.inf)
+                    t = np.sum(w*d, where=k)
+                    ws = np.sum(w, where=k)
+                else:
+                    # nothing finite, np.min would fail on the empty selection
+                    lo, hi, t, ws = np.inf, -np.inf, 0.0, 0.0
+                flags = _nonfinite(d)
+
+            minval[v] = min(minval[v], lo)
+            maxval[v] = max(maxval[v], hi)
+            total[v] += t
+            wsum[v] += ws
+            nonfinite[v] += bad
+            zs[v].append((lo, hi, ws) + flags)
+
+    result = {}
+    for v in vars:
+        # no finite value, or no weight, e.g. a column that failed everywhere
+        mean = total[v]/wsum[v] if wsum[v] != 0 else np.nan
+        s = {'min': minval[v], 'max': maxval[v], 'mean': mean,
+             'nonfinite': nonfinite[v], 'wsum': wsum[v]}
+        if where is None:
+            s['zones'] = np.array(zs[v], dtype=np.float64).reshape(-1, len(ZONE))
+        result[v] = s
+    return result
+
+
+def zone(x, w=None):
+    """The entry of the zone map for a chunk of values x with weights w."""
+    keep = np.isfinite(x)
+    flags = (0, 0, 0) if keep.all() else _nonfinite(x)
+    x = x[keep]
+    if x.shape[0] == 0:
+        return (np.inf, -np.inf, 0.0) + flags
+    return (x.min(), x.max(), np.nan if w is None else np.sum(w[keep])) + flags
+
+
+def _nonfinite(x):
+    """The flags of a zone map entry, whether x has -inf, +inf and NaN."""
+    return (int(np.isneginf(x).any()), int(np.isposinf(x).any()), int(np.isnan(x).any()))
+
+
+def expression(expr, names):
+    """Compile an expression of columns, e.g. 'log10(C_1)' or '`m_{\\chi}`*1e3'.
+
+    Columns are referred to by name, names that are not Python identifiers
+    are quoted with backticks. Returns the expression with the columns
+    replaced by the variables _0, _1, ..., and the list of the columns.
+    Raises ValueError unless the expression only combines columns and
+    numbers with arithmetic, comparisons and the functions of numexpr.
+    """
+    args = []
+
+    def ref(name):
+        if name not in args:
+            args.append(name)
+        return '_%d' % args.index(name)
+
+    expr = re.sub(r'`([^`]*)`', lambda m: ref(m.group(1)), expr)
+    expr = re.sub(r'(?<![\w.])[A-Za-z_]\w*',
+                  lambda m: ref(m.group(0)) if m.group(0) in names else m.group(0),
+                  expr)
+
+    _compile(expr)
+    return expr, args
+
+
+def evaluate(expr, values):
+    """Evaluate a compiled expression with the values of its columns.
+
+    Uses numexpr, which evaluates in parallel threads without temporaries,
+    if installed and numpy otherwise.
+    """
+    code = _compile(expr)
+    local = {'_%d' % k: v for k, v in enumerate(values)}
+
+    if numexpr is not None:
+        return numexpr.evaluate(expr, local_dict=local, global_dict={})
+
+    return eval(code, {'__builtins__': {}}, dict(_NUMPY, **local))
+
+
+# the nodes of an expression besides names, numbers and function calls
+_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.BoolOp,
+          ast.operator, ast.unaryop, ast.cmpop, ast.boolop, ast.Load)
+
 
-    return (minval, maxval, mean)
+@functools.lru_cache(maxsize=256)
+def _compile(expr):
+    """Compile expr, an expression from expression, after checking that it only
+    uses the columns _0, _1, ..., numbers, operators and calls of the
+    functions in _NUMPY. Expressions are read from chain files, and reading
+    a file must never run code, which eval without the check would.
+    """
+    try:
+        tree = ast.parse(expr, mode='eval')
+    except SyntaxError:
+        raise ValueError('Invalid expression %s.' % expr)
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            ok = (isinstance(node.func, ast.Name) and node.func.id in _NUMPY
+                  and not node.keywords)
+        elif isinstance(node, ast.Name):
+            ok = node.id in _NUMPY or re.fullmatch(r'_\d+', node.id) is not None
+        elif isinstance(node, ast.Constant):
+            ok = type(node.value) in (int, float, complex, bool)
+        else:
+            ok = isinstance(node, _NODES)
+        if not ok:
+            raise ValueError('Unsupported expression %s, only columns, numbers, '
+                             'operators and numexpr functions are allowed.' % expr)
+
+    return compile(tree, '<expression>', 'eval')
+
+
+# the numexpr functions, for evaluating expressions with numpy
+_NUMPY = {k: getattr(np, k) for k in (
+    'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2',
+    'sinh', 'cosh', 'tanh', 'arcsinh', 'arccosh', 'arctanh',
+    'log', 'log10', 'log1p', 'exp', 'expm1', 'sqrt', 'abs', 'where',
+    'real', 'imag', 'conj', 'floor', 'ceil')}
+
+
+def chunks(h5, names, start=0, stop=None):
+    """Iterator over the named columns, one chunk at a time.
+
+    Yields the row offset of the chunk and a list with the rows of each
+    column, in the order of names. The chunk size is that of the first
+    column, so every column is read exactly once per chunk. Columns in the
+    block dataset are all read together in a single read per chunk.
+    Virtual columns are calculated chunk by chunk from the columns they
+    depend on, which are read once however many virtual columns use them.
+
+    The next PREFETCH chunks are read in a background thread while the
+    caller works on the current one, into buffers that are reused: the
+    arrays of a chunk are only valid until the next chunk is asked for.
+    """
+    return profiling.loop(_chunks(h5, names, start, stop))
+
+
+def _chunks(h5, names, start, stop):
+    first = column(h5, names[0])
+    s = readsize(first)
+    n = first.shape[0] if stop is None else stop
+
+    read = profiling.reader(_reader(h5, names))
+    bounds = [(i, min(i+s, n)) for i in range(start, n, s)]
+
+    for (i, e), cols in zip(bounds, prefetch(read, bounds)):
+        yield i, cols
+
+
+def select(h5, names, where=None, start=0, stop=None, ranges=None):
+    """Iterator over the rows of the named columns selected by where, one
+    chunk at a time.
+
+    where is an expression (see expression), e.g. '`\\Omega_{\\chi}h^2` < 0.12',
+    or the name of a mask column, non-zero for selected rows. It is
+    evaluated chunk by chunk from its own columns first, and the other
+    columns are only read for chunks with selected rows.
+
+    ranges is a dictionary of (low, high) intervals of columns, rows outside
+    them are of no interest to the caller, but not removed. Chunks that the
+    zone maps (see zones) show have no rows of interest, or none where can
+    select, are skipped without being read.
+
+    Yields the indices of the selected rows and a list with the selected
+    rows of each column, as chunks. Without where every row is selected.
+    As with chunks, the arrays are only valid until the next chunk is
+    asked for.
+    """
+    return profiling.loop(_select(h5, names, where, start, stop, ranges))
+
+
+def _select(h5, names, where, start, stop, ranges):
+    first = column(h5, names[0])
+    s = readsize(first)
+    n = first.shape[0] if stop is None else stop
+
+    if where is None:
+        code, args = None, []
+    else:
+        code, args = selection(h5, where)
+    rest = [k for k in names if k not in args]
+
+    maybe = _skippable(h5, s, code, args, ranges) if start % s == 0 else None
+
+    read_args = profiling.reader(_reader(h5, args)) if args else None
+    read_rest = profiling.reader(_reader(h5, rest)) if rest else None
+
+    bounds = []
+    for i in range(start, n, s):
+        if maybe is not None and not maybe[i // s]:
+            profiling.skip()
+            continue
+        bounds.append((i, min(i+s, n)))
+
+    # the columns of where are read ahead, the rest only for selected rows
+    for (i, e), cols in zip(bounds, prefetch(read_args or read_rest, bounds)):
+
+        if where is None:
+            yield np.arange(i, e), cols
+            continue
+
+        v = dict(zip(args, cols))
+        mask = np.asarray(evaluate(code, [v[a] for a in args]), dtype=bool)
+        mask = np.broadcast_to(mask, (e - i,))
+        if not mask.any():
+            continue
+
+        if rest:
+            v.update(zip(rest, read_rest(i, e)))
+
+        yield i + np.flatnonzero(mask), [v[k][mask] for k in names]
+
+
+def zones(h5, name, chunksize=None):
+    """The zone map of the named column, an (nchunks, len(ZONE)) array of
+    the min and max of the finite values, the weight sum, and whether there
+    are -inf, +inf and NaN values, of each chunk. None if there is none up
+    to date for chunks of chunksize rows.
+    """
+    if ZONES not in h5 or name not in h5[ZONES]:
+        return None
+
+    z = h5[ZONES][name]
+    c = column(h5, name)
+    if chunksize is not None and z.attrs['chunksize'] != chunksize:
+        return None
+    if z.shape[0] != -(-c.shape[0] // z.attrs['chunksize']):
+        return None
+    if z.ndim != 2 or z.shape[1] != len(ZONE):
+        # without the non-finite flags, written by an older version
+        return None
+
+    return z[...]
+
+
+def store_zones(h5, name, z, chunksize, post_col):
+    """Store the zone map z of the named column, see zones."""
+    g = h5.require_group(ZONES)
+    if name in g:
+        del g[name]
+    d = g.create_dataset(name, data=z)
+    d.attrs['chunksize'] = chunksize
+    d.attrs['post_col'] = post_col
+
+
+def _skippable(h5, s, code, args, ranges):
+    """Whether each chunk may have rows of interest, from the zone maps,
+    None if nothing can be skipped.
+    """
+    maybe = None
+
+    # non-finite values are outside any finite range
+    for k, (lo, hi) in (ranges or {}).items():
+        z = zones(h5, k, s)
+        if z is not None:
+            m = (z[:, 1] >= lo) & (z[:, 0] <= hi)
+            maybe = m if maybe is None else maybe & m
+
+    # but where sees them, infinities widen the bounds and NaN is != anything
+    if code is not None:
+        bounds = {}
+        for j, a in enumerate(args):
+            z = zones(h5, a, s)
+            if z is not None:
+                bounds['_%d' % j] = (np.where(z[:, 3] > 0, -np.inf, z[:, 0]),
+                                     np.where(z[:, 4] > 0, np.inf, z[:, 1]),
+                                     z[:, 5] > 0)
+        if bounds:
+            m = _possible(ast.parse(code, mode='eval').body, bounds)
+            if m is not None:
+                maybe = m if maybe is None else maybe & m
+
+    return maybe
+
+
+_FLIP = {ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE,
+         ast.Eq: ast.Eq, ast.NotEq: ast.NotEq}
+
+
+def _possible(node, bounds):
+    """Whether the condition node can be true in each chunk given the
+    (min, max, has NaN) bounds of its columns in every chunk, None if unknown.
+    Understands comparisons of columns with numbers, combined with & and |.
+    """
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        a = _possible(node.left, bounds)
+        b = _possible(node.right, bounds)
+        if isinstance(node.op, ast.BitAnd):
+            return b if a is None else a if b is None else a & b
+        return None if a is None or b is None else a | b
+
+    if isinstance(node, ast.BoolOp):
+        ms = [_possible(v, bounds) for v in node.values]
+        if isinstance(node.op, ast.And):
+            ms = [m for m in ms if m is not None]
+            return np.logical_and.reduce(ms) if ms else None
+        return None if any(m is None for m in ms) else np.logical_or.reduce(ms)
+
+    if isinstance(node, ast.Compare):
+        terms = [node.left] + node.comparators
+        result = None
+        for a, op, b in zip(terms[:-1], node.ops, terms[1:]):
+            m = _compare(a, type(op), b, bounds)
+            if m is not None:
+                result = m if result is None else result & m
+        return result
+
+    return None
+
+
+def _compare(a, op, b, bounds):
+    if isinstance(b, ast.Name) and not isinstance(a, ast.Name):
+        a, b, op = b, a, _FLIP.get(op)
+
+    if not isinstance(a, ast.Name) or a.id not in bounds or op is None:
+        return None
+    try:
+        c = float(ast.literal_eval(b))
+    except (ValueError, TypeError, SyntaxError):
+        return None
+
+    lo, hi, nan = bounds[a.id]
+    if op is ast.Lt:
+        return lo < c
+    if op is ast.LtE:
+        return lo <= c
+    if op is ast.Gt:
+        return hi > c
+    if op is ast.GtE:
+        return hi >= c
+    if op is ast.Eq:
+        return (lo <= c) & (c <= hi)
+    if op is ast.NotEq:
+        return ~((lo == c) & (hi == c)) | nan
+    return None
+
+
+def selection(h5, where):
+    """Compile where, an expression or the name of a mask column, see select."""
+    if where in names(h5):
+        return '_0 != 0', [where]
+    return expression(where, names(h5))
+
+
+def prefetch(read, bounds):
+    """Iterator over read(i, e) for the (i, e) in bounds, reading PREFETCH
+    ahead in a background thread. HDF5 releases the GIL while it reads and
+    decompresses, so that overlaps with the work of the caller.
+
+    read takes a dictionary of buffers to reuse, see _reader. Each of the
+    PREFETCH + 1 dictionaries is only reused when the caller asks for the
+    chunk after the one read into it.
+    """
+    if PREFETCH < 1:
+        for i, e in bounds:
+            yield read(i, e)
+        return
+
+    buffers = [{} for k in range(PREFETCH + 1)]
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    pending = collections.deque()
+    try:
+        for k, (i, e) in enumerate(bounds):
+            pending.append(pool.submit(read, i, e, buffers[k % len(buffers)]))
+            if len(pending) > PREFETCH:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _reader(h5, names):
+    """A function reading the rows [i, e) of the named columns, each once.
+
+    It takes an optional dictionary out of buffers, that the chunked
+    datasets are read into and that is filled on first use.
+    """
+    cols = [column(h5, k) for k in names]
+
+    virtuals = [c for c in cols if isinstance(c, VirtualColumn)]
+    if virtuals:
+        needed = []
+        for k, c in zip(names, cols):
+            for a in (c.args if isinstance(c, VirtualColumn) else [k]):
+                if a not in needed:
+                    needed.append(a)
+
+        read_needed = _reader(h5, needed)
+
+        def read(i, e, out=None):
+            v = dict(zip(needed, read_needed(i, e, out)))
+            return [c.evaluate([v[a] for a in c.args]) if isinstance(c, VirtualColumn)
+                    else v[k] for k, c in zip(names, cols)]
+        return read
+
+    inblock = sorted(set(c.index for c in cols if isinstance(c, BlockColumn)))
+    pos = {j: k for k, j in enumerate(inblock)}
+    if inblock:
+        block = mapped(h5[BLOCK])
+        whole = len(inblock) == block.shape[1]
+
+    def read(i, e, out=None):
+        if inblock:
+            b = block[i:e] if whole else block[i:e, inblock]
+
+        values = []
+        for j, c in enumerate(cols):
+            if isinstance(c, BlockColumn):
+                values.append(b[:, pos[c.index]])
+            elif out is not None and isinstance(c, h5py.Dataset) and e > i:
+                if j not in out or out[j].shape[0] < e - i:
+                    out[j] = np.empty((e - i,) + c.shape[1:], dtype=c.dtype)
+                c.read_direct(out[j], np.s_[i:e], np.s_[0:e-i])
+                values.append(out[j][:e-i])
+            else:
+                values.append(c[i:e])
+        return values
+    return read
+
+
+def slices(n, chunksize, parts):
+    """Split the rows [0, n) into at most parts chunk aligned (start, stop)
+    slices of roughly equal size.
+    """
+    nchunks = -(-n // chunksize)
+    bounds = np.linspace(0, nchunks, min(parts, nchunks) + 1).astype(int)*chunksize
+    bounds[-1] = n
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _scan(args):
+    P, start, stop = args
+    P._scan(start, stop)
+    return P
+
+
+def restore(P, cache, **request):
+    """The barrett.cache.Cache of cache, see scan, and whether P, constructed
+    with the keyword arguments request, was set up and filled from it. It
+    is then not set up, which may take passes over the data for statistics
+    and bins. Otherwise scan records the request with the grid it stores.
+    """
+    if cache is True:
+        cache = barrett.cache.Cache(os.fspath(request['h5file']) + '.cache')
+
+    P._request = request
+    return cache, cache is not None and cache.restore(P, request)
+
+
+def scan(P, workers=None, cache=None):
+    """Fill P by scanning all rows of its file, optionally split over a pool
+    of worker processes.
+
+    P is a posterior or profilelikelihood object that has been set up but
+    not filled. With workers each process opens the file read-only, fills
+    a copy of P from its own chunk aligned slice of the rows, and the
+    partial results are merged back into P.
 
+    cache is a barrett.cache.Cache, or True for one next to the file. P is
+    filled from it without reading the file if it can be, otherwise it is
+    stored there once filled.
 
-def filechunk(f, chunksize):
-    """Iterator that allow for piecemeal processing of a file."""
+    The oneD and twoD grids of posterior and profilelikelihood all take
+    these options: workers and cache as above, where selecting the rows to
+    use (see select), bins and budget. The bins are a number, an array of
+    edges, or a rule such as 'auto', 'fd', 'knuth' or 'quantile' choosing
+    them from the data (see binedges). Chosen bins are limited to a grid of
+    budget bytes, binning.BUDGET by default. Without limits they are those
+    of the data, whose min, max and mean are then kept, otherwise these
+    are None.
+    """
+    if cache is True:
+        cache = barrett.cache.Cache(os.fspath(P.h5file) + '.cache')
+
+    if cache is not None and cache.load(P):
+        return
+
+    if workers is None or workers <= 1:
+        P._scan(0, P.n)
+    else:
+        tasks = [(P, start, stop) for start, stop in slices(P.n, P.chunksize, workers)]
+
+        # every task is pickled before P is touched by the merge
+        pool = multiprocessing.Pool(workers)
+        try:
+            parts = pool.map(_scan, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for part in parts:
+            P._merge(part)
+
+    if cache is not None:
+        cache.store(P)
+
+
+def filechunk(f, chunksize, ncols=None):
+    """Iterator that allow for piecemeal processing of a file.
+
+    Yields the next chunksize rows of the open text file f as a 2D array,
+    so memory use is bounded by chunksize however large the file. With
+    ncols every row must have that many columns.
+    """
     while True:
         chunk = tuple(itertools.islice(f, chunksize))
         if not chunk:
             return
-        yield np.loadtxt(iter(chunk), dtype=np.float64)
+        yield parseblock(chunk, ncols)
+
+
+def parseblock(lines, ncols=None):
+    """Parse lines of whitespace separated floats into a 2D array.
+
+    Uses np.fromstring, which parses in C, instead of the much slower
+    np.loadtxt. Blank lines are skipped, every other line must have ncols,
+    by default as many as the first, values.
+    """
+    counts = [len(line.split()) for line in lines]
+    lines = [line for line, c in zip(lines, counts) if c]
+    counts = [c for c in counts if c]
+    if ncols is None:
+        ncols = counts[0] if counts else 0
+
+    # rows of the wrong length would otherwise be run together into others
+    for k, c in enumerate(counts):
+        if c != ncols:
+            raise ValueError('Malformed row %d of the block, %d columns instead of %d.'
+                             % (k, c, ncols))
+
+    d = np.fromstring(' '.join(lines), dtype=np.float64, sep=' ')
+
+    if d.shape[0] != len(lines)*ncols:
+        raise ValueError('Malformed block of %d rows, expected %d columns per row.'
+                         % (len(lines), ncols))
+
+    return d.reshape(len(lines), ncols)
+
+
+def textranges(txtfile, blocksize):
+    """Split a text file into (txtfile, start, stop) byte ranges of roughly
+    blocksize rows each, estimated from the length of the first row.
+    """
+    size = os.path.getsize(txtfile)
+    with open(txtfile, 'rb') as f:
+        rowbytes = max(len(f.readline()), 1)
+
+    step = max(blocksize*rowbytes, 1)
+    return [(txtfile, i, min(i+step, size)) for i in range(0, size, step)]
+
+
+def _fileblocks(txtfile, blocksize, ncols):
+    with open(txtfile, 'r') as f:
+        yield from filechunk(f, blocksize, ncols)
+
+
+def _parserange(args):
+    """Parse the rows starting within the byte range [start, stop) of txtfile."""
+    txtfile, start, stop, ncols = args
+
+    with open(txtfile, 'rb') as f:
+        if start > 0:
+            # the row running over start belongs to the previous range
+            f.seek(start - 1)
+            f.readline()
+
+        pos = f.tell()
+        if pos >= stop:
+            return np.zeros((0, ncols))
+
+        text = f.read(stop - pos)
+        if not text.endswith(b'\n'):
+            text += f.readline()
+
+    return parseblock(text.decode().splitlines(), ncols)
+
+
+def _imap(pool, func, tasks, window, ordered=True):
+    """pool.imap, or imap_unordered, with at most window tasks submitted and
+    not yet taken, so that parsed blocks do not pile up in memory when they
+    are written slower than they are parsed.
+    """
+    tasks = iter(tasks)
+
+    if ordered:
+        pending = collections.deque(pool.apply_async(func, (t,))
+                                    for t in itertools.islice(tasks, window))
+        while pending:
+            r = pending.popleft().get()
+            for t in itertools.islice(tasks, 1):
+                pending.append(pool.apply_async(func, (t,)))
+            yield r
+        return
+
+    done = queue.Queue()
+    n = 0
+    for t in itertools.islice(tasks, window):
+        pool.apply_async(func, (t,), callback=done.put, error_callback=done.put)
+        n += 1
+    while n > 0:
+        r = done.get()
+        n -= 1
+        if isinstance(r, BaseException):
+            raise r
+        for t in itertools.islice(tasks, 1):
+            pool.apply_async(func, (t,), callback=done.put, error_callback=done.put)
+            n += 1
+        yield r
+
+
+def storage(compression='gzip'):
+    """The create_dataset keywords of a compression profile.
+
+    A profile is 'gzip', 'lzf', 'blosc', 'zstd', 'lz4' or None for no
+    compression, optionally with a level, e.g. 'gzip:9' or 'zstd:5'. blosc,
+    zstd and lz4 need the hdf5plugin package, also to read the file.
+    """
+    if compression is None or compression == 'none':
+        return {}
+
+    name, _, level = compression.partition(':')
+    level = int(level) if level else None
+
+    if name == 'gzip':
+        return {'compression': 'gzip',
+                'compression_opts': 4 if level is None else level,
+                'shuffle': True}
+    if name == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+
+    if name not in ('blosc', 'zstd', 'lz4'):
+        raise ValueError('Unknown compression %s.' % compression)
+    if hdf5plugin is None:
+        raise ImportError('The %s compression needs the hdf5plugin package.' % name)
 
+    if name == 'blosc':
+        return dict(hdf5plugin.Blosc(cname='lz4',
+                                     clevel=5 if level is None else level,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if name == 'zstd':
+        opts = dict(hdf5plugin.Zstd(clevel=3 if level is None else level))
+    else:
+        opts = dict(hdf5plugin.LZ4())
+    opts['shuffle'] = True
+    return opts
 
+
+@profiling.operation
+def rechunk(h5file, newfile, chunksize, compression='gzip'):
+    """Copy every column of h5file into newfile with a new chunk size and
+    compression profile. Attributes, e.g. the cached statistics, are kept.
+    """
+    src = session.h5open(h5file, 'r')
+    dst = h5py.File(newfile, 'w')
+
+    for k, v in src.attrs.items():
+        dst.attrs[k] = v
+    dst.attrs['barrett.compression'] = compression or 'none'
+
+    for name, d in src.items():
+        # the zone maps are of the old chunks
+        if name == ZONES:
+            continue
+
+        x = dst.create_dataset(name,
+                               shape=d.shape,
+                               maxshape=(None,) + d.shape[1:],
+                               dtype=d.dtype,
+                               chunks=(chunksize,) + d.shape[1:],
+                               **storage(compression))
+        for k, v in d.attrs.items():
+            x.attrs[k] = v
+
+        d = mapped(d)
+        step = max(chunksize, d.chunks[0] if d.chunks else 0)
+        for i in range(0, d.shape[0], step):
+            x[i:i+step] = d[i:i+step]
+
+    for name in names(dst):
+        stamp(dst, name)
+
+    dst.close()
+    src.close()
+
+
+@profiling.operation
+def contiguous(h5file, newfile, npy=False):
+    """Copy every column of h5file into newfile uncompressed and contiguous,
+    for chains that are read very often. Readers then map the data into
+    memory (see MappedColumn) and take WINDOW rows at a time as views,
+    without decompressing chunks or calling into HDF5.
+
+    With npy the data of each column is written to <name>.npy in the
+    directory next to newfile named after it, without the extension, plus
+    _npy, and newfile refers to those files, which can also be opened
+    with np.load(..., mmap_mode='r'). The columns of newfile cannot grow,
+    Chain.append into it fails.
+    """
+    src = session.h5open(h5file, 'r')
+    dst = h5py.File(newfile, 'w')
+
+    if npy:
+        npydir = os.path.splitext(newfile)[0] + '_npy'
+        if not os.path.isdir(npydir):
+            os.makedirs(npydir)
+
+    for k, v in src.attrs.items():
+        dst.attrs[k] = v
+    dst.attrs['barrett.compression'] = 'none'
+
+    for name, d in src.items():
+        # the zone maps are of the old chunks
+        if name == ZONES:
+            continue
+
+        if npy and d.size > 0:
+            path = os.path.join(npydir, name + '.npy')
+            m = np.lib.format.open_memmap(path, mode='w+', dtype=d.dtype, shape=d.shape)
+            external = [(os.path.join(os.path.basename(npydir), name + '.npy'),
+                         m.offset, m.nbytes)]
+        else:
+            m = None
+            external = None
+
+        x = dst.create_dataset(name, shape=d.shape, dtype=d.dtype, external=external)
+        for k, v in d.attrs.items():
+            x.attrs[k] = v
+
+        d = mapped(d)
+        step = max(WINDOW, readsize(d))
+        for i in range(0, d.shape[0], step):
+            if m is None:
+                x[i:i+step] = d[i:i+step]
+            else:
+                m[i:i+step] = d[i:i+step]
+
+        if m is not None:
+            m.flush()
+            del m
+
+    for name in names(dst):
+        stamp(dst, name)
+
+    dst.close()
+    src.close()
+
+
+@profiling.operation
+def autotune_chunksize(h5file,
+                       var='mult',
+                       chunksizes=(1000, 10000, 100000, 1000000),
+                       compression='gzip',
+                       nrows=1000000,
+                       repeat=3):
+    """Measure how fast a variable can be scanned for different chunk sizes.
+
+    The first nrows rows of the variable are written to an in-memory HDF5 file
+    with each chunk size and the compression profile, and then read back one
+    chunk at a time, which is how every barrett reduction reads the data.
+    The best of repeat scans counts.
+
+    Returns the chunk size with the highest throughput and a dictionary of
+    the throughput, in rows per second, of every chunk size tried. Use
+    rechunk to apply the chunk size to an existing file or pass it to
+    convert_chain for a new one.
+    """
+    f = session.h5open(h5file, 'r')
+    sample = column(f, var)[:nrows]
+    f.close()
+
+    rates = {}
+    for chunksize in chunksizes:
+        chunksize = min(chunksize, sample.shape[0])
+
+        mem = h5py.File('autotune-%d.h5' % chunksize, 'w',
+                        driver='core', backing_store=False)
+        mem.create_dataset(var,
+                           data=sample,
+                           maxshape=(None,),
+                           chunks=(chunksize,),
+                           **storage(compression))
+
+        best = np.inf
+        for r in range(repeat):
+            t0 = time.time()
+            for i, cols in chunks(mem, [var]):
+                pass
+            best = min(best, time.time() - t0)
+        mem.close()
+
+        rates[chunksize] = sample.shape[0]/max(best, 1e-9)
+
+    return max(rates, key=rates.get), rates
+
+
+@profiling.operation
 def convert_chain(
         txtfiles,
         headers,
         h5file,
-        chunksize):
+        chunksize,
+        post_col='mult',
+        blocksize=None,
+        verbose=False,
+        workers=None,
+        ordered=True,
+        compression='gzip',
+        layout='columns',
+        groupsize=None):
     """Converts chain in plain text format into HDF5 format.
 
     Keyword arguments:
@@ -66,37 +1428,101 @@ def convert_chain(
     headers -- name of each column.
     h5file -- where to put the resulting HDF5 file.
     chunksize -- how large the HDF5 chunk, i.e. number of rows.
+    post_col -- the posterior weight column, if among the headers the
+                statistics of every column are cached (see colstats).
+    blocksize -- number of rows parsed and written at a time, default
+                 chunksize. Peak memory use is proportional to it.
+    verbose -- print the conversion rate in rows per second as it goes.
+    workers -- number of processes parsing blocks of the text files in
+               parallel. Only this process writes to the HDF5 file.
+    ordered -- with workers, keep the rows in the order of the input files,
+               otherwise write blocks in the order they are parsed.
+    compression -- the compression profile of the columns, see storage.
+    layout -- 'columns' for one dataset per column, 'block' for a single
+              (n, ncols) dataset holding all columns row by row, or 'both'.
+              Readers take the columns from the block when there is one.
+    groupsize -- number of columns per chunk of the block, default all, so
+                 reading any columns of a chunk is a single chunk read.
 
     Chunking - How to pick a chunksize
-    TODO Optimal chunk size unknown, our usage make caching irrelevant, and
-    we use all read variable. Larger size should make compression more efficient,
-    and less require less IO reads. Measurements needed.
+    Our usage make caching irrelevant, and we use all read variable. Larger
+    size should make compression more efficient, and less require less IO
+    reads. autotune_chunksize measures the read throughput of a chain for
+    a range of chunk sizes, rechunk applies the best one.
     """
 
+    blocksize = chunksize if blocksize is None else blocksize
+    ncols = len(headers)
+
+    if layout not in ('columns', 'block', 'both'):
+        raise ValueError('Unknown layout %s.' % layout)
+
     h5 = h5py.File(h5file, 'w')
+    try:
+        h5.attrs['barrett.compression'] = compression or 'none'
+
+        datasets = []
+
+        if layout != 'block':
+            for h in headers:
+                datasets.append(h5.create_dataset(h,
+                                                  shape=(0,),
+                                                  maxshape=(None,),
+                                                  dtype=np.float64,
+                                                  chunks=(chunksize,),
+                                                  **storage(compression)))
+
+        if layout != 'columns':
+            block = h5.create_dataset(BLOCK,
+                                      shape=(0, ncols),
+                                      maxshape=(None, ncols),
+                                      dtype=np.float64,
+                                      chunks=(chunksize, groupsize or ncols),
+                                      **storage(compression))
+            block.attrs['barrett.columns'] = list(headers)
+
+        pool = None
+        if workers is None or workers <= 1:
+            blocks = (d for txtfile in txtfiles
+                        for d in _fileblocks(txtfile, blocksize, ncols))
+        else:
+            tasks = [r + (ncols,) for txtfile in txtfiles
+                                  for r in textranges(txtfile, blocksize)]
+            pool = multiprocessing.Pool(workers)
+            blocks = _imap(pool, _parserange, tasks, 2*workers, ordered)
+
+        nrows = 0
+        t0 = time.time()
+
+        try:
+            for d in blocks:
 
-    for h in headers:
-        h5.create_dataset(h,
-                          shape=(0,),
-                          maxshape=(None,),
-                          dtype=np.float64,
-                          chunks=(chunksize,),
-                          compression='gzip',
-                          shuffle=True)
+                dnrows = d.shape[0]
 
-    for txtfile in txtfiles:
+                for pos, x in enumerate(datasets):
+                    x.resize(nrows+dnrows, axis=0)
+                    x[nrows:] = d[:,pos]
 
-        d = np.loadtxt(txtfile, dtype=np.float64)
+                if layout != 'columns':
+                    block.resize(nrows+dnrows, axis=0)
+                    block[nrows:] = d
 
-        if len(d.shape) == 1:
-            d = np.array([d])
+                nrows += dnrows
 
-        dnrows = d.shape[0]
+                if verbose:
+                    print('%d rows, %.0f rows/s' % (nrows, nrows/(time.time()-t0)))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
-        for pos, h in enumerate(headers):
-            x = h5[h]
-            xnrows = x.shape[0]
-            x.resize(dnrows+xnrows, axis=0)
-            x[xnrows:] = d[:,pos]
+        for h in headers:
+            stamp(h5, h)
 
-    h5.close()
+        if post_col in headers and nrows > 0:
+            for h, st in _colstats(h5, list(headers), post_col).items():
+                store_zones(h5, h, st.pop('zones'), chunksize, post_col)
+                for d in copies(h5, h):
+                    store_stats(d, post_col, st)
+    finally:
+        h5.close()
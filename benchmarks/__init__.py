@@ -0,0 +1,12 @@
+""" Benchmarks of the hot paths of barrett on synthetic MultiNest chains.
+
+Run them with
+
+  python -m benchmarks --rows 1000000 --output results.json
+
+and compare two runs, e.g. of different commits, with
+
+  python -m benchmarks compare before.json after.json
+
+See python -m benchmarks --help for the shape of the chain.
+"""
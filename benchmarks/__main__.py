@@ -0,0 +1,150 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+import barrett.util as util
+from benchmarks import chains
+from benchmarks.suite import BENCHMARKS, measure
+
+
+def collect(p, results):
+    """The report of the benchmark process p, None if it died without one."""
+    while True:
+        try:
+            return results.get(timeout=1.0)
+        except queue.Empty:
+            if not p.is_alive():
+                # it may have put its report just before exiting
+                try:
+                    return results.get(timeout=1.0)
+                except queue.Empty:
+                    return None
+
+
+def run(a):
+    a.tmp = tempfile.mkdtemp(prefix='barrett-bench-')
+    try:
+        a.txt = os.path.join(a.tmp, 'chain.txt')
+        a.h5 = os.path.join(a.tmp, 'chain.h5')
+
+        print('Writing a chain of %d rows and %d parameters' % (a.rows, a.cols))
+        a.headers = chains.synthetic(a.txt, a.rows, a.cols, a.skew, a.nonfinite, a.ordered,
+                                     a.seed)
+        util.convert_chain([a.txt], a.headers, a.h5, a.chunksize, compression=a.compression)
+
+        # a fresh process of its own, which does not start with the memory
+        # of this one, so the peak memory is that of the benchmark
+        ctx = multiprocessing.get_context('spawn')
+        results = []
+        for func in BENCHMARKS:
+            if a.only and func.__name__ not in a.only:
+                continue
+
+            q = ctx.Queue()
+            p = ctx.Process(target=measure, args=(func, a, q))
+            p.start()
+            r = collect(p, q)
+            p.join()
+
+            if r is None:
+                r = {'name': func.__name__,
+                     'error': 'The benchmark process died with exit code %s.' % p.exitcode}
+            if 'error' in r:
+                print('%-24s failed\n%s' % (r['name'], r['error']))
+            else:
+                print('%-24s %8.3f s %12.0f rows/s %8.1f MB/s %8.1f MB %8.1f MB'
+                      % (r['name'], r['seconds'], r['rows_per_s'], r['mb_per_s'],
+                         r['peak_rss_mb'], r['rss_increase_mb']))
+            results.append(r)
+    finally:
+        shutil.rmtree(a.tmp)
+
+    report = {'commit': commit(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'chain': {k: getattr(a, k) for k in ('rows', 'cols', 'skew', 'nonfinite',
+                                                   'ordered', 'seed', 'chunksize',
+                                                   'compression', 'workers', 'bins',
+                                                   'repeat')},
+              'platform': {'python': platform.python_version(),
+                           'machine': platform.machine(),
+                           'cpus': multiprocessing.cpu_count(),
+                           'numpy': np.__version__,
+                           'h5py': h5py.__version__,
+                           'hdf5': h5py.version.hdf5_version},
+              'results': results}
+
+    if a.output:
+        f = open(a.output, 'w')
+        json.dump(report, f, indent=2)
+        f.close()
+
+
+def compare(before, after):
+    """Print the times of two runs side by side."""
+    runs = []
+    for path in (before, after):
+        f = open(path)
+        runs.append(json.load(f))
+        f.close()
+
+    times = [{r['name']: r['seconds'] for r in run['results'] if 'error' not in r}
+             for run in runs]
+
+    print('%-24s %10s %10s %8s' % ('', runs[0]['commit'][:10], runs[1]['commit'][:10], 'speedup'))
+    for name in times[0]:
+        if name in times[1]:
+            print('%-24s %8.3f s %8.3f s %7.2fx'
+                  % (name, times[0][name], times[1][name], times[0][name]/times[1][name]))
+
+
+def commit():
+    """The git commit of the working tree, unknown outside a git checkout."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        p = argparse.ArgumentParser(prog='python -m benchmarks compare')
+        p.add_argument('before')
+        p.add_argument('after')
+        a = p.parse_args(sys.argv[2:])
+        compare(a.before, a.after)
+        return
+
+    p = argparse.ArgumentParser(prog='python -m benchmarks',
+                                description='Time the hot paths of barrett on a synthetic chain.')
+    p.add_argument('--rows', type=int, default=1000000)
+    p.add_argument('--cols', type=int, default=10, help='number of parameters')
+    p.add_argument('--skew', type=float, default=1.0, help='spread of the weights')
+    p.add_argument('--nonfinite', type=float, default=0.001,
+                   help='fraction of NaN and inf parameter values')
+    p.add_argument('--ordered', action='store_true', help='blocks of rows sorted by likelihood')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--chunksize', type=int, default=10000)
+    p.add_argument('--compression', default='gzip')
+    p.add_argument('--workers', type=int, default=None)
+    p.add_argument('--bins', type=int, default=100)
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--only', nargs='*', choices=[f.__name__ for f in BENCHMARKS])
+    p.add_argument('--output', help='JSON file of the results')
+    run(p.parse_args())
+
+
+if __name__ == '__main__':
+    main()
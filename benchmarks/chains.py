@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def headers(ncols):
+    """Column names of a synthetic chain with ncols parameters."""
+    return ['mult', '-2lnL'] + ['x%d' % j for j in range(ncols)]
+
+
+def synthetic(path, nrows, ncols=10, skew=1.0, nonfinite=0.0, ordered=False, seed=0,
+              blocksize=100000):
+    """ Write a reproducible synthetic MultiNest chain to the text file path.
+
+    The ncols parameters are correlated normal variables, -2lnL their chi
+    squared, and the posterior weight mult is exp(-skew*(-2lnL)/2), so
+    skew=0 gives equal weights and larger skew weights spanning more orders
+    of magnitude, like a MultiNest posterior. A fraction nonfinite of the
+    parameter values are NaN or inf. ordered sorts every block of rows by
+    decreasing -2lnL, like the dead points of a nested sampling run.
+
+    The same arguments always give the same file. Returns the headers.
+    """
+    rng = np.random.default_rng(seed)
+
+    # a fixed correlation, the same for every block
+    mix = np.eye(ncols) + 0.3*rng.standard_normal((ncols, ncols))/np.sqrt(ncols)
+
+    f = open(path, 'w')
+    for i in range(0, nrows, blocksize):
+        n = min(blocksize, nrows - i)
+
+        z = rng.standard_normal((n, ncols))
+        chi2 = np.sum(z**2, axis=1)
+        x = z.dot(mix.T)
+
+        if nonfinite > 0:
+            bad = rng.random(x.shape) < nonfinite
+            x[bad] = np.where(rng.random(np.count_nonzero(bad)) < 0.5, np.nan, np.inf)
+
+        block = np.column_stack((np.exp(-skew*chi2/2.0), chi2, x))
+        if ordered:
+            block = block[np.argsort(-chi2, kind='mergesort')]
+
+        np.savetxt(f, block, fmt='%.8e')
+    f.close()
+
+    return headers(ncols)
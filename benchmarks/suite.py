@@ -0,0 +1,133 @@
+""" The benchmarks, each run in a fresh process by python -m benchmarks. """
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import time
+import traceback
+
+import h5py
+
+import barrett.util as util
+import barrett.posterior as posterior
+import barrett.profilelikelihood as profilelikelihood
+import barrett.data as data
+
+
+def convert(a):
+    t0 = time.time()
+    util.convert_chain([a.txt], a.headers, os.path.join(a.tmp, 'convert.h5'), a.chunksize,
+                       compression=a.compression, workers=a.workers)
+    return time.time() - t0, os.path.getsize(a.txt)
+
+
+def threenum(a):
+    h5file = os.path.join(a.tmp, 'threenum.h5')
+    shutil.copy(a.h5, h5file)
+
+    # without the statistics convert_chain cached
+    h5 = h5py.File(h5file, 'r+')
+    util.clear_stats(h5, 'x0')
+    h5.close()
+
+    t0 = time.time()
+    util.threenum(h5file, 'x0', cache=False)
+    return time.time() - t0, 2*8*a.rows
+
+
+def summary(a):
+    t0 = time.time()
+    util.summary(a.h5, a.headers[2:], workers=a.workers)
+    return time.time() - t0, (len(a.headers) - 1)*8*a.rows
+
+
+def posterior_oneD(a):
+    t0 = time.time()
+    posterior.oneD(a.h5, 'x0', bins=a.bins, workers=a.workers)
+    return time.time() - t0, 2*8*a.rows
+
+
+def posterior_twoD(a):
+    t0 = time.time()
+    posterior.twoD(a.h5, 'x0', 'x1', xbins=a.bins, ybins=a.bins, workers=a.workers)
+    return time.time() - t0, 3*8*a.rows
+
+
+def posterior_matrix(a):
+    vars = a.headers[2:6]
+    t0 = time.time()
+    posterior.Matrix(a.h5, vars, bins=a.bins)
+    return time.time() - t0, (len(vars) + 1)*8*a.rows
+
+
+def profilelikelihood_oneD(a):
+    t0 = time.time()
+    profilelikelihood.oneD(a.h5, 'x0', bins=a.bins, workers=a.workers)
+    return time.time() - t0, 2*8*a.rows
+
+
+def profilelikelihood_twoD(a):
+    t0 = time.time()
+    profilelikelihood.twoD(a.h5, 'x0', 'x1', xbins=a.bins, ybins=a.bins, workers=a.workers)
+    return time.time() - t0, 3*8*a.rows
+
+
+def chain_apply(a):
+    h5file = os.path.join(a.tmp, 'apply.h5')
+    shutil.copy(a.h5, h5file)
+
+    t0 = time.time()
+    data.Chain(h5file).apply('y', lambda x0, x1: x0*x1, 'x0', 'x1')
+    return time.time() - t0, 3*8*a.rows
+
+
+def chain_bestfit(a):
+    h5file = os.path.join(a.tmp, 'bestfit.h5')
+    shutil.copy(a.h5, h5file)
+
+    t0 = time.time()
+    data.Chain(h5file).bestfit(k=10)
+    return time.time() - t0, 8*a.rows
+
+
+BENCHMARKS = [convert, threenum, summary,
+              posterior_oneD, posterior_twoD, posterior_matrix,
+              profilelikelihood_oneD, profilelikelihood_twoD,
+              chain_apply, chain_bestfit]
+
+
+def maxrss():
+    """The peak resident memory of this process so far, in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss/2.0**10 if sys.platform != 'darwin' else rss/2.0**20
+
+
+def measure(func, a, results):
+    """Run the benchmark func repeat times in this process, report the best,
+    or the error.
+    """
+    # only this process is spawned, the workers of the benchmark fork from
+    # it as usual instead of starting and importing barrett each
+    multiprocessing.set_start_method('fork', force=True)
+
+    try:
+        base = maxrss()
+        times = []
+        for r in range(a.repeat):
+            t, nbytes = func(a)
+            times.append(t)
+        rss = maxrss()
+    except Exception:
+        results.put({'name': func.__name__, 'error': traceback.format_exc()})
+        return
+
+    best = min(times)
+    results.put({'name': func.__name__,
+                 'seconds': best,
+                 'times': times,
+                 'rows_per_s': a.rows/best,
+                 'mb_per_s': nbytes/2.0**20/best,
+                 'peak_rss_mb': rss,
+                 'rss_increase_mb': rss - base})
@@ -28,6 +28,10 @@ def pairplot(dataset, vars, filename, bins=60):
     """
     n = len(vars)
 
+    # all the 1D and 2D posteriors are calculated in a single pass over the data
+    M = posterior.Matrix(dataset+'.h5', vars,
+                         limits={x: limits(x) for x in vars}, bins=bins)
+
     fig, axes = plt.subplots(nrows=n, ncols=n)
     plt.subplots_adjust(wspace=0.1, hspace=0.1)
 
@@ -39,7 +43,7 @@ def pairplot(dataset, vars, filename, bins=60):
                 ax.axis('off')
                 continue
             elif i == j:
-                P = posterior.oneD(dataset+'.h5', x, limits=limits(x), bins=bins)
+                P = M[x, x]
                 P.plot(ax)
                 ax.set_xlim(limits(x))
                 ax.spines['right'].set_visible(False)
@@ -47,8 +51,7 @@ def pairplot(dataset, vars, filename, bins=60):
                 ax.xaxis.set_ticks_position('bottom')
                 ax.set_yticks([])
             else:
-                P = posterior.twoD(dataset+'.h5', x, y,
-                        xlimits=limits(x), ylimits=limits(y), xbins=bins, ybins=bins)
+                P = M[x, y]
 
                 # apply some gaussian smoothing to make the contours slightly smoother
                 sigmas = (np.diff(P.ycenters)[0], np.diff(P.xcenters)[0])
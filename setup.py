@@ -25,5 +25,6 @@ setup(name='barrett',
       ],
       keywords='out-of-core multinest statistics visualisation',
       packages=['barrett'],
-      install_requires=['numpy', 'scipy', 'h5py', 'matplotlib']
+      install_requires=['numpy', 'scipy', 'h5py', 'matplotlib'],
+      extras_require={'plugins': ['hdf5plugin'], 'numexpr': ['numexpr']}
 )